@@ -1,16 +1,30 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 import logging
-from typing import Any
+from typing import Any, Iterator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
 from decimal import Decimal
 
+from .metrics import Metrics
+from .ratelimit import RateLimiter, retry_after
+from .retry import CircuitBreaker, CircuitOpen as CircuitOpen, RemoteUnavailable, RetryPolicy
+
 BASE_URL = "https://api.holded.com/api/invoicing/v1"
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+
+
+def _never_sent(e: Exception) -> bool:
+    """Whether the request failed before reaching the server, so resending it is always safe"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
 
 
 @dataclass
@@ -98,6 +112,41 @@ class Document:
 @dataclass(frozen=True)
 class Holded:
     api_key: str
+    # Maximum number of keep-alive connections kept open against the API
+    pool_size: int = 10
+    # Seconds, a stalled socket raises instead of blocking the caller forever
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    # Paces requests and honors 429/Retry-After, share it between clients using the same key
+    rate_limiter: RateLimiter = field(default_factory=RateLimiter, repr=False, compare=False)
+    retry_policy: RetryPolicy = field(default_factory=RetryPolicy, repr=False, compare=False)
+    circuit_breaker: CircuitBreaker = field(
+        default_factory=CircuitBreaker, repr=False, compare=False
+    )
+    metrics: Metrics = field(default_factory=Metrics, repr=False, compare=False)
+    _session: requests.Session = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.headers.update(
+            {
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "Key": self.api_key,
+            }
+        )
+        object.__setattr__(self, "_session", session)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
     def _call(
         self,
@@ -106,25 +155,75 @@ class Holded:
         params: dict[str, Any] | None = None,
         payload: dict[str, Any] | None = None,
     ) -> dict | list:
-        try:
-            ret = requests.request(
-                method,
-                BASE_URL + endpoint,
-                headers={
-                    "Accept": "application/json",
-                    "Content-Type": "application/json",
-                    "Key": self.api_key,
-                },
-                json=payload,
-                params=params,
-            )
-            body = ret.json()
-        except Exception as e:
-            logger.error("Error on request %s", e)
-            sleep(10)
-            return self._call(method=method, endpoint=endpoint, params=params, payload=payload)
-
-        if type(body) is dict and "status" in body.keys() and body["status"] != 1:
+        attempts = self.retry_policy.attempts
+        error = None
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.metrics.retry(endpoint, method)
+            self.circuit_breaker.check()
+            start = monotonic()
+            self.rate_limiter.acquire(method)
+            sent = monotonic()
+            self.metrics.throttled(endpoint, method, sent - start)
+            status: int | str | None = None
+            try:
+                ret = self._session.request(
+                    method,
+                    BASE_URL + endpoint,
+                    json=payload,
+                    params=params,
+                    timeout=(self.connect_timeout, self.read_timeout),
+                )
+                status = ret.status_code
+                if ret.status_code >= 500:
+                    ret.raise_for_status()
+                body = ret.json() if ret.status_code != 429 else None
+            except Exception as e:
+                self.metrics.observe(
+                    endpoint, method, status or type(e).__name__, monotonic() - sent
+                )
+                self.circuit_breaker.record_failure()
+                error = e
+                if method != "GET" and not _never_sent(e):
+                    # The write may have been applied already, resending it could duplicate it
+                    raise RemoteUnavailable(
+                        "{} {} failed, not retried: {}".format(method, endpoint, e)
+                    ) from e
+                if attempt + 1 < attempts:
+                    delay = self.retry_policy.delay(attempt)
+                    logger.error(
+                        "Error on request %s %s (%s/%s), retrying in %.1fs: %s",
+                        method,
+                        endpoint,
+                        attempt + 1,
+                        attempts,
+                        delay,
+                        e,
+                    )
+                    sleep(delay)
+                continue
+            self.metrics.observe(endpoint, method, ret.status_code, monotonic() - sent)
+            self.circuit_breaker.record_success()
+
+            if ret.status_code == 429:
+                delay = retry_after(ret)
+                logger.warning("Rate limited on %s %s, waiting %.1fs", method, endpoint, delay)
+                self.rate_limiter.pause(method, delay)
+                error = ApiError("rate limited")
+                continue
+            break
+        else:
+            raise RemoteUnavailable(
+                "{} {} failed after {} attempts".format(method, endpoint, attempts)
+            ) from error
+
+        # Documents have a `status` field of their own (payment status), errors have no id
+        if (
+            type(body) is dict
+            and "status" in body.keys()
+            and body["status"] != 1
+            and "id" not in body.keys()
+        ):
             raise ApiError(body.get("info", "no info associated"))
         return body
 
@@ -137,56 +236,109 @@ class Holded:
         sort: DocumentSort | None = None,
         paid: DocumentStatus | None = None,
     ) -> list[Document]:
-        ret = self._call(
-            "GET",
-            f"/documents/{type.value}",
-            params={
-                "starttmp": start.timestamp() if start else None,
-                "endtmp": end.timestamp() if end else None,
-                "contactId": contact_id,
-                "sort": sort.value if sort else None,
-                "paid": paid.value if paid else None,
-            },
+        return self._into_documents(
+            type,
+            self._call(
+                "GET",
+                f"/documents/{type.value}",
+                params=self._list_documents_params(start, end, contact_id, sort, paid),
+            ),
         )
 
-        return [
-            Document(
-                type=type,
-                id=i["id"],
-                number=i["docNumber"],
-                status=DocumentStatus(i["status"]),
-                date=datetime.fromtimestamp(i["date"]),
-                buyer=i["contact"],
-                items=[
-                    Item(
-                        name=p["name"],
-                        desc=p["desc"],
-                        units=p["units"],
-                        taxes=p["taxes"],
-                        subtotal=Decimal(p["price"]),
-                        discount=Decimal(p["discount"]),
-                        tax_percentage=Decimal(p["tax"]),
-                    )
-                    for p in i["products"]
-                ],
-                tags=i.get("tags", []),
-                custom_fields=None,
-                numbering_series_id=None,
-                notes=i.get("notes"),
-                payments=[
-                    Payment(
-                        date=datetime.fromtimestamp(p["date"]),
-                        amount=Decimal(p["amount"]),
-                        desc=None,
-                    )
-                    for p in i.get("paymentsDetail", [])
-                ],
-                total=Decimal(i["total"]),
-                paid=Decimal(i["paymentsTotal"]),
-                pending=Decimal(i["paymentsPending"]),
-            )
-            for i in ret
-        ]
+    def iter_documents(
+        self,
+        type: DocumentType,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        contact_id: str | None = None,
+        sort: DocumentSort | None = None,
+        paid: DocumentStatus | None = None,
+        limit: int | None = None,
+    ) -> Iterator[Document]:
+        """
+        Same as `list_documents` but pages through the listing, yielding documents as each page
+        arrives and stopping after `limit` documents
+        """
+        for raw in self._paginate(
+            f"/documents/{type.value}",
+            self._list_documents_params(start, end, contact_id, sort, paid),
+            limit,
+        ):
+            yield self._into_listed_document(type, raw)
+
+    def _paginate(self, endpoint: str, params: dict[str, Any], limit: int | None) -> Iterator[dict]:
+        if limit is not None and limit <= 0:
+            return
+        seen = set()
+        page = 1
+        while True:
+            items = self._call("GET", endpoint, params=params | {"page": page})
+            # A page with nothing new also means the API is ignoring `page`
+            new = [i for i in items if i["id"] not in seen]
+            if len(new) == 0:
+                return
+            for item in new:
+                yield item
+                seen.add(item["id"])
+                if limit is not None and len(seen) >= limit:
+                    return
+            page += 1
+
+    def _list_documents_params(
+        self,
+        start: datetime | None,
+        end: datetime | None,
+        contact_id: str | None,
+        sort: DocumentSort | None,
+        paid: DocumentStatus | None,
+    ) -> dict[str, Any]:
+        return {
+            "starttmp": start.timestamp() if start else None,
+            "endtmp": end.timestamp() if end else None,
+            "contactId": contact_id,
+            "sort": sort.value if sort else None,
+            "paid": paid.value if paid else None,
+        }
+
+    def _into_documents(self, type: DocumentType, ret: list) -> list[Document]:
+        return [self._into_listed_document(type, i) for i in ret]
+
+    def _into_listed_document(self, type: DocumentType, i: dict) -> Document:
+        return Document(
+            type=type,
+            id=i["id"],
+            number=i["docNumber"],
+            status=DocumentStatus(i["status"]),
+            date=datetime.fromtimestamp(i["date"]),
+            buyer=i["contact"],
+            items=[
+                Item(
+                    name=p["name"],
+                    desc=p["desc"],
+                    units=p["units"],
+                    taxes=p["taxes"],
+                    subtotal=Decimal(p["price"]),
+                    discount=Decimal(p["discount"]),
+                    tax_percentage=Decimal(p["tax"]),
+                )
+                for p in i["products"]
+            ],
+            tags=i.get("tags", []),
+            custom_fields=None,
+            numbering_series_id=None,
+            notes=i.get("notes"),
+            payments=[
+                Payment(
+                    date=datetime.fromtimestamp(p["date"]),
+                    amount=Decimal(p["amount"]),
+                    desc=None,
+                )
+                for p in i.get("paymentsDetail", [])
+            ],
+            total=Decimal(i["total"]),
+            paid=Decimal(i["paymentsTotal"]),
+            pending=Decimal(i["paymentsPending"]),
+        )
 
     # --- NUEVO: convertir un dict en Document, reutilizado por get_document ---
     def _into_document_from_dict(self, type: DocumentType, i: dict) -> Document:
@@ -243,7 +395,13 @@ class Holded:
             raise ApiError(f"Documento {type.value}/{id} no encontrado")
 
     def create_document(self, document: Document, draft: bool = True) -> str:
-        payload = {
+        payload = self._document_payload(document, draft)
+        logger.debug("Payload factura => %s", payload)
+        ret = self._call("POST", f"/documents/{document.type.value}", payload=payload)
+        return ret["id"]
+
+    def _document_payload(self, document: Document, draft: bool) -> dict:
+        return {
             "language": "es",
             "contactId": document.buyer.id,
             "date": int(document.date.timestamp()),
@@ -267,9 +425,6 @@ class Holded:
             "notes": document.notes,
             "approveDoc": not draft,
         }
-        logger.debug("Payload factura => %s", payload)
-        ret = self._call("POST", f"/documents/{document.type.value}", payload=payload)
-        return ret["id"]
 
     def _contact_payload(self, c: Contact) -> dict:
         payload = {
@@ -332,12 +487,16 @@ class Holded:
     def get_contact_by_id(self, id: str) -> Contact | None:
         try:
             return self._into_contact(self._call("GET", f"/contacts/{id}"))
+        except RemoteUnavailable:
+            raise
         except Exception:
             return None
 
     def get_contact_by_mobile(self, mobile: str) -> Contact | None:
         try:
             return self._into_contact(self._call("GET", "/contacts", params={"mobile": mobile})[0])
+        except RemoteUnavailable:
+            raise
         except Exception:
             return None
 
@@ -346,8 +505,28 @@ class Holded:
             return self._into_contact(
                 self._call("GET", "/contacts", params={"customId": [custom_id]})[0]
             )
+        except RemoteUnavailable:
+            raise
         except Exception:
             return None
 
+    def search_contacts(
+        self, custom_id: str | None = None, mobile: str | None = None
+    ) -> list[Contact]:
+        """
+        Contacts with `custom_id`, or else `mobile`. Unlike `get_contact_by_custom_id` and
+        `get_contact_by_mobile` errors are raised, an empty list means there are none.
+        """
+        params = {"customId": [custom_id]} if custom_id is not None else {"mobile": mobile}
+        return [self._into_contact(c) for c in self._call("GET", "/contacts", params=params)]
+
     def list_contacts(self) -> list[Contact]:
         return [self._into_contact(c) for c in self._call("GET", "/contacts")]
+
+    def iter_contacts(self, limit: int | None = None) -> Iterator[Contact]:
+        """Same as `list_contacts` but pages through the listing, see `iter_documents`"""
+        for raw in self._paginate("/contacts", {}, limit):
+            yield self._into_contact(raw)
+
+
+from .aio import AsyncHolded  # noqa: E402, F401  (needs the definitions above)
@@ -0,0 +1,139 @@
+# asyncio front-end for the Holded client
+#
+# Requests still go through the blocking `Holded._call` (and therefore through its pooled
+# session) but run on a dedicated thread pool, so independent lookups can overlap. The number
+# of concurrent requests is capped by `concurrency`, keep it at or below the client's
+# `pool_size`.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from dataclasses import dataclass, field
+from datetime import datetime
+import logging
+from typing import Any
+
+from holded import (
+    ApiError,
+    Contact,
+    Document,
+    DocumentSort,
+    DocumentStatus,
+    DocumentType,
+    Holded,
+    RemoteUnavailable,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AsyncHolded:
+    client: Holded
+    concurrency: int = 4
+    _executor: ThreadPoolExecutor = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Not tied to an event loop, so the same client can be used by successive `asyncio.run`
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="holded"
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _call(
+        self,
+        method: str,
+        endpoint: str,
+        params: dict[str, Any] | None = None,
+        payload: dict[str, Any] | None = None,
+    ) -> dict | list:
+        # With the caller's context variables, as `asyncio.to_thread` does
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, ctx.run, self.client._call, method, endpoint, params, payload
+        )
+
+    async def list_documents(
+        self,
+        type: DocumentType,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        contact_id: str | None = None,
+        sort: DocumentSort | None = None,
+        paid: DocumentStatus | None = None,
+    ) -> list[Document]:
+        return self.client._into_documents(
+            type,
+            await self._call(
+                "GET",
+                f"/documents/{type.value}",
+                params=self.client._list_documents_params(start, end, contact_id, sort, paid),
+            ),
+        )
+
+    async def get_document(self, type: DocumentType, id: str) -> Document:
+        raw = await self._call("GET", f"/documents/{type.value}/{id}")
+        if isinstance(raw, dict):
+            return self.client._into_document_from_dict(type, raw)
+        elif isinstance(raw, list) and raw:
+            return self.client._into_document_from_dict(type, raw[0])
+        else:
+            raise ApiError(f"Documento {type.value}/{id} no encontrado")
+
+    async def create_document(self, document: Document, draft: bool = True) -> str:
+        payload = self.client._document_payload(document, draft)
+        logger.debug("Payload factura => %s", payload)
+        ret = await self._call("POST", f"/documents/{document.type.value}", payload=payload)
+        return ret["id"]
+
+    async def create_contact(self, contact: Contact):
+        payload = self.client._contact_payload(contact)
+        logger.debug("Payload create_contact => %s", payload)
+        return (await self._call("POST", "/contacts", payload=payload))["id"]
+
+    async def update_contact(self, contact: Contact):
+        payload = self.client._contact_payload(contact)
+        logger.debug("Payload update_contact => %s", payload)
+        return (await self._call("PUT", f"/contacts/{contact.id}", payload=payload))["id"]
+
+    async def get_contact_by_id(self, id: str) -> Contact | None:
+        try:
+            return self.client._into_contact(await self._call("GET", f"/contacts/{id}"))
+        except RemoteUnavailable:
+            raise
+        except Exception:
+            return None
+
+    async def get_contact_by_mobile(self, mobile: str) -> Contact | None:
+        try:
+            return self.client._into_contact(
+                (await self._call("GET", "/contacts", params={"mobile": mobile}))[0]
+            )
+        except RemoteUnavailable:
+            raise
+        except Exception:
+            return None
+
+    async def get_contact_by_custom_id(self, custom_id: str) -> Contact | None:
+        try:
+            return self.client._into_contact(
+                (await self._call("GET", "/contacts", params={"customId": [custom_id]}))[0]
+            )
+        except RemoteUnavailable:
+            raise
+        except Exception:
+            return None
+
+    async def search_contacts(
+        self, custom_id: str | None = None, mobile: str | None = None
+    ) -> list[Contact]:
+        params = {"customId": [custom_id]} if custom_id is not None else {"mobile": mobile}
+        return [
+            self.client._into_contact(c)
+            for c in await self._call("GET", "/contacts", params=params)
+        ]
+
+    async def list_contacts(self) -> list[Contact]:
+        return [self.client._into_contact(c) for c in await self._call("GET", "/contacts")]
@@ -0,0 +1,69 @@
+# Request metrics
+#
+# Counts requests by endpoint and status, failed attempts, retries and time spent waiting on the
+# rate limiter, and keeps a latency histogram per endpoint. Ids in the path are replaced by `{id}`
+# so each endpoint is a single series. `snapshot` returns plain data, ready to be merged with the
+# snapshots of other clients or processes and exported.
+
+from threading import Lock
+from typing import Any
+
+# Upper bounds in seconds of the latency histogram buckets, the last one is +Inf
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint_label(endpoint: str) -> str:
+    return "/".join("{id}" if any(c.isdigit() for c in s) else s for s in endpoint.split("/"))
+
+
+class Metrics:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self._requests: dict[tuple[str, str, str], int] = {}
+        self._errors: dict[tuple[str, str, str], int] = {}
+        self._retries: dict[tuple[str, str], int] = {}
+        self._throttled: dict[tuple[str, str], float] = {}
+        self._latency: dict[tuple[str, str], list[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, endpoint: str, method: str, status: int | str, seconds: float):
+        """
+        A finished attempt: `status` is the HTTP status code, or the name of the exception
+        raised when there is no response. Statuses of 400 and above count as errors.
+        """
+        key = (endpoint_label(endpoint), method)
+        status = str(status)
+        failed = not status.isdigit() or int(status) >= 400
+        with self._lock:
+            self._requests[(*key, status)] = self._requests.get((*key, status), 0) + 1
+            if failed:
+                self._errors[(*key, status)] = self._errors.get((*key, status), 0) + 1
+            # One count per bucket (the last one is +Inf), then the sum
+            hist = self._latency.setdefault(key, [0] * (len(self.buckets) + 2))
+            i = next((i for i, b in enumerate(self.buckets) if seconds <= b), len(self.buckets))
+            hist[i] += 1
+            hist[-1] += seconds
+
+    def retry(self, endpoint: str, method: str):
+        key = (endpoint_label(endpoint), method)
+        with self._lock:
+            self._retries[key] = self._retries.get(key, 0) + 1
+
+    def throttled(self, endpoint: str, method: str, seconds: float):
+        """Time an attempt waited on the rate limiter before being sent"""
+        if seconds <= 0:
+            return
+        key = (endpoint_label(endpoint), method)
+        with self._lock:
+            self._throttled[key] = self._throttled.get(key, 0.0) + seconds
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "requests": dict(self._requests),
+                "errors": dict(self._errors),
+                "retries": dict(self._retries),
+                "throttled": dict(self._throttled),
+                "latency": {k: list(v) for k, v in self._latency.items()},
+            }
@@ -1,39 +1,111 @@
+import asyncio
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
 import logging
 import dataclasses
 from decimal import Decimal
 import itertools
 import threading
-from repairdesk import RepairDesk
+from repairdesk import AsyncRepairDesk, RepairDesk
 import repairdesk
-from holded import Holded
+from holded import AsyncHolded, Holded
 import holded
 from datetime import datetime, timedelta
-import json
 import os
+import history
+import runtime
+import tracing
+from .checkpoint import Checkpoint, CheckpointStore
+from .contacts import ContactIndex
+from .statuses import ClosedStatuses
+from .fingerprints import FingerprintStore, SyncedInvoice, fingerprint
+from .invoices import InvoiceIndex
+from .workqueue import Entry, WorkQueue
 from .utils import (
     append_warning,
     convert_customer,
     convert_document,
     find_holded_invoice_by_number,
     from_numbering_series,
+    into_numbering_series,
     convert_payment,
 )
 
 HOLDED_API_KEY = os.environ["HOLDED_API_KEY"]
 REPAIRDESK_API_KEY = os.environ["REPAIRDESK_API_KEY"]
-CONFIG = json.load(open("/etc/repairdesk-to-holded.conf.json"))
+CONFIG = runtime.config()
 
-logging.basicConfig()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-logger.addHandler(logging.FileHandler("/tmp/logs.txt"))
 
-rd = RepairDesk(REPAIRDESK_API_KEY)
-hd = Holded(HOLDED_API_KEY)
 
-# Contains the name of all ticket statuses in the "Closed" category
-CLOSED_STATUS_LIST = list(
-    map(lambda s: s.name, filter(lambda s: s.type == "Closed", rd.ticket_statuses()))
+class _CountedMetrics:
+    """Cuenta cada petición también en el trabajo para el que se hace, ver history"""
+
+    def observe(self, *args, **kwargs):
+        super().observe(*args, **kwargs)  # type: ignore[misc]
+        history.count("api_calls")
+
+
+class _RepairDeskMetrics(_CountedMetrics, repairdesk.Metrics):
+    pass
+
+
+class _HoldedMetrics(_CountedMetrics, holded.Metrics):
+    pass
+
+
+# Tickets are cached across restarts, the closed ones for much longer (see closed_statuses)
+tickets = repairdesk.TicketCache(
+    repairdesk.SQLiteBackend(runtime.data_path("tickets.sqlite3")),
+    closed_ttl=timedelta(days=CONFIG.get("ticket_cache_closed_ttl", 30)),
+    open_ttl=timedelta(minutes=CONFIG.get("ticket_cache_open_ttl", 10)),
+)
+rd = RepairDesk(
+    REPAIRDESK_API_KEY,
+    rate_limiter=repairdesk.RateLimiter(**CONFIG.get("rate_limits", {}).get("repairdesk", {})),
+    retry_policy=repairdesk.RetryPolicy(**CONFIG.get("retry", {})),
+    circuit_breaker=repairdesk.CircuitBreaker(**CONFIG.get("circuit_breaker", {})),
+    ticket_cache=tickets,
+    metrics=_RepairDeskMetrics(),
+)
+hd = Holded(
+    HOLDED_API_KEY,
+    rate_limiter=holded.RateLimiter(**CONFIG.get("rate_limits", {}).get("holded", {})),
+    retry_policy=holded.RetryPolicy(**CONFIG.get("retry", {})),
+    circuit_breaker=holded.CircuitBreaker(**CONFIG.get("circuit_breaker", {})),
+    metrics=_HoldedMetrics(),
+)
+# Shares the connection pool of `rd`, used to fetch invoice details in parallel
+ard = AsyncRepairDesk(rd, concurrency=CONFIG.get("repairdesk_concurrency", 8))
+# Same for `hd`, used to look up the contacts of a batch of invoices in parallel
+ahd = AsyncHolded(hd, concurrency=CONFIG.get("holded_concurrency", 4))
+contacts = ContactIndex(hd, max_age=timedelta(hours=CONFIG.get("contact_index_max_age", 6)))
+invoices_index = InvoiceIndex(
+    hd,
+    runtime.data_path("invoices.sqlite3"),
+    full_reload=timedelta(hours=CONFIG.get("invoice_index_full_reload", 24)),
+    refresh=timedelta(minutes=CONFIG.get("invoice_index_refresh", 10)),
+)
+# Content hashes of the invoices already synced, unchanged ones are skipped on rescans
+fingerprints = FingerprintStore(runtime.data_path("fingerprints.sqlite3"))
+# Last RepairDesk invoice synced by `sync_new_invoices`, where the next run resumes from
+checkpoints = CheckpointStore(runtime.data_path("checkpoint.json"))
+
+# Invoices waiting between two stages of the sync pipeline (see sync_queued)
+PIPELINE_QUEUE_SIZE = CONFIG.get("pipeline_queue_size", 50)
+# Invoice details fetched from RepairDesk and contacts looked up in Holded at once
+FETCH_WORKERS = ard.concurrency
+CONTACT_WORKERS = ahd.concurrency
+# RepairDesk invoice listings are requested in pages of this size and decoded incrementally
+LIST_PAGE_SIZE = 1000
+# Number of most recently created Holded invoices checked to find where to resume syncing
+LAST_INVOICES_LOOKBEHIND = 50
+
+# Contains the name of all ticket statuses in the "Closed" category, fetched on first use
+closed_statuses = ClosedStatuses(
+    rd,
+    runtime.data_path("ticket_statuses.json"),
+    refresh=timedelta(hours=CONFIG.get("ticket_statuses_refresh", 24)),
 )
 
 
@@ -61,12 +133,48 @@ def _strip_addr_fields(c: holded.Contact):
 
 
 # ---------- sincronía de contacto ----------
-def _sync_contact(contact: holded.Contact) -> holded.Contact:
+async def _lookup_contact(contact: holded.Contact) -> holded.Contact | None:
+    # Los errores se propagan, para no recordar como inexistente un contacto que no se pudo buscar
     found = None
     if contact.custom_id is not None:
-        found = hd.get_contact_by_custom_id(contact.custom_id)
+        found = next(iter(await ahd.search_contacts(custom_id=contact.custom_id)), None)
     if found is None and contact.mobile is not None:
-        found = hd.get_contact_by_mobile(contact.mobile)
+        found = next(iter(await ahd.search_contacts(mobile=contact.mobile)), None)
+    return found
+
+
+async def _resolve_contact(
+    invoice: repairdesk.Invoice, lookups: dict[str, asyncio.Task[holded.Contact | None]]
+):
+    """
+    Busca en Holded el cliente de la factura si no está en el índice de contactos.
+    `lookups` son las búsquedas ya lanzadas por customId, un cliente con varias
+    facturas seguidas se busca una sola vez. Los fallos se ignoran, _sync_contact
+    volverá a buscarlo por su cuenta.
+    """
+    if int(invoice.customer.id) == 0:  # walk-in, se descarta en _sync_invoice
+        return
+    try:
+        contact = convert_customer(invoice.customer)
+        if contact.custom_id is None:
+            return
+        # Recargar el índice lista todos los contactos, que no pare el resto de etapas
+        await asyncio.to_thread(contacts.ensure_loaded)
+        if contacts.cached(contact) is not None:
+            return
+        if contact.custom_id not in lookups:
+            lookups[contact.custom_id] = asyncio.create_task(_lookup_contact(contact))
+        found = await lookups[contact.custom_id]
+    except Exception:
+        return
+    if found is not None:
+        contacts.put(found)
+    else:
+        contacts.missed(contact)
+
+
+def _sync_contact(contact: holded.Contact) -> holded.Contact:
+    found = contacts.get(contact)
 
     if found:
         need_update = (
@@ -84,86 +192,153 @@ def _sync_contact(contact: holded.Contact) -> holded.Contact:
         contact.id = found.id
         try:
             hd.update_contact(contact)
+            contacts.put(contact)
             return contact
-        except Exception as e:
+        except holded.ApiError as e:
+            # Solo si Holded la rechaza; un RemoteUnavailable puede haberse aplicado ya
             logger.warning(
                 "Holded rechazó update_contact con dirección (%s). Reintentando sin dirección...", e
             )
             safe = dataclasses.replace(contact) if hasattr(dataclasses, "replace") else contact
             _strip_addr_fields(safe)
             hd.update_contact(safe)
+            contacts.put(safe)
             return safe
 
     # Crear nuevo
-    logging.info("Creating new customer %s (id: %s)", contact.name, getattr(contact, "id", None))
+    logger.info("Creating new customer %s (id: %s)", contact.name, getattr(contact, "id", None))
+    created = contact
     try:
         new_id = hd.create_contact(contact=contact)
-    except Exception as e:
+    except holded.RemoteUnavailable:
+        # Puede haberse creado, el reintento tiene que volver a buscarlo en Holded
+        contacts.clear_missed(contact)
+        raise
+    except holded.ApiError as e:
+        # Solo si Holded lo rechaza; tras un RemoteUnavailable puede existir ya y se duplicaría
         logger.warning(
             "Holded rechazó create_contact con dirección (%s). Reintentando sin dirección...", e
         )
         safe = dataclasses.replace(contact) if hasattr(dataclasses, "replace") else contact
         _strip_addr_fields(safe)
         new_id = hd.create_contact(contact=safe)
+        created = safe
 
-    created = hd.get_contact_by_id(new_id)
-    assert created is not None
+    # Lo que acabamos de enviar es el contacto, no hace falta volver a pedirlo a Holded
+    created = dataclasses.replace(created, id=new_id)
+    contacts.put(created)
     return created
 
 
+# ---------- búsqueda de facturas en Holded ----------
+def _find_holded_invoice(contact: holded.Contact, number: str) -> holded.Document | None:
+    indexed = invoices_index.find(contact.id, number)
+    if indexed is None:
+        if not invoices_index.is_uncertain(number):
+            return None
+        # Un intento anterior de crearla falló sin respuesta, puede existir sin estar indexada
+        logger.info("Invoice %s may have been created already, searching Holded", number)
+        found = find_holded_invoice_by_number(hd, contact, number)
+        if found is not None:
+            invoices_index.put(found)
+        invoices_index.settle(number)
+        return found
+    try:
+        return hd.get_document(holded.DocumentType.INVOICE, indexed.id)
+    except holded.ApiError:
+        # Borrada en Holded desde la última carga del índice, se busca como antes
+        logger.info("Holded invoice %s no longer exists, searching again", indexed.id)
+        invoices_index.remove(indexed.id)
+        found = find_holded_invoice_by_number(hd, contact, number)
+        if found is not None:
+            invoices_index.put(found)
+        return found
+
+
 # ---------- sincronía de facturas ----------
 def _sync_invoice(rd_invoice: repairdesk.Invoice):
     """
-    Crea/actualiza la factura y registra pagos.
-    - Tolerancia de 0,01 en comparaciones.
-    - Si RD marca 'PAID' pero los pagos de RD no alcanzan el total por céntimos,
-      añadimos un pago de ajuste por la diferencia exacta (hasta 0,05) para
-      dejarla en Pagado en Holded.
+    Sincroniza la factura salvo que no haya cambiado desde la última vez que quedó
+    sincronizada y su documento siga en Holded.
     """
-    TOL = Decimal("0.01")
-    logger.debug("Syncing invoice %s", rd_invoice.order_id)
-    rebu = False
+    history.count("scanned")
+    with tracing.invoice(rd_invoice.order_id):
+        with tracing.span("fingerprint"):
+            fp = fingerprint(rd_invoice)
+            synced = fingerprints.get(str(rd_invoice.id))
+            unchanged = (
+                synced is not None
+                and synced.fingerprint == fp
+                and invoices_index.contains(synced.hd_invoice_id)
+            )
+        if unchanged:
+            logger.debug("Invoice %s unchanged, skipping", rd_invoice.order_id)
+            history.count("skipped")
+            return
 
-    # --- Sanity checks ---
+        hd_invoice_id = _sync_invoice_to_holded(rd_invoice)
+        if hd_invoice_id is not None:
+            fingerprints.put(SyncedInvoice(str(rd_invoice.id), fp, hd_invoice_id))
+        elif synced is not None:
+            fingerprints.remove(str(rd_invoice.id))
+
+
+def _sanity_problem(rd_invoice: repairdesk.Invoice) -> str | None:
+    """
+    Motivo por el que la factura se descarta sin llegar a Holded, None si pasa las
+    comprobaciones. No necesita el ticket, se mira antes de pedirlo.
+    """
+    TOL = Decimal("0.01")
     suma_lineas = sum(map(lambda i: i.total, rd_invoice.items))
     if abs(suma_lineas - rd_invoice.total) > TOL:
-        append_warning(
-            message=(
-                "failed sanity check: sum(items) != total "
-                f"(items={suma_lineas}, total={rd_invoice.total})"
-            ),
-            rd_invoice_id=str(rd_invoice.id),
-            order_id=rd_invoice.order_id,
-            hd_invoice_id=None,
+        return (
+            "failed sanity check: sum(items) != total "
+            f"(items={suma_lineas}, total={rd_invoice.total})"
         )
-        logger.warning("Invoice %s descartada por sum(items) != total", rd_invoice.order_id)
-        return
 
     if CONFIG["used_goods_tax_class"] in map(lambda i: i.tax_class, rd_invoice.items):
         for item in rd_invoice.items:
             if item.total != Decimal(0) and item.tax_class != CONFIG["used_goods_tax_class"]:
-                append_warning(
-                    message="failed sanity check: REBU invoice contains other items with non-zero price",
-                    rd_invoice_id=str(rd_invoice.id),
-                    order_id=rd_invoice.order_id,
-                    hd_invoice_id=None,
-                )
-                logger.warning("Invoice %s descartada por mixto REBU", rd_invoice.order_id)
-                return
-        rebu = True
+                return "failed sanity check: REBU invoice contains other items with non-zero price"
 
     if int(rd_invoice.customer.id) == 0:
+        return "failed sanity check: walkin customer invoices are not allowed"
+
+    return None
+
+
+def _sync_invoice_to_holded(rd_invoice: repairdesk.Invoice) -> str | None:
+    """
+    Crea/actualiza la factura y registra pagos.
+    - Tolerancia de 0,01 en comparaciones.
+    - Si RD marca 'PAID' pero los pagos de RD no alcanzan el total por céntimos,
+      añadimos un pago de ajuste por la diferencia exacta (hasta 0,05) para
+      dejarla en Pagado en Holded.
+    Devuelve el id del documento en Holded si ha quedado sincronizado sin avisos
+    pendientes, None en otro caso.
+    """
+    TOL = Decimal("0.01")
+    logger.debug("Syncing invoice %s", rd_invoice.order_id)
+    # Pasa a False si queda algún aviso que obliga a revisar la factura en el próximo escaneo
+    clean = True
+
+    # --- Sanity checks ---
+    with tracing.span("sanity"):
+        problem = _sanity_problem(rd_invoice)
+    if problem is not None:
         append_warning(
-            message="failed sanity check: walkin customer invoices are not allowed",
+            message=problem,
             rd_invoice_id=str(rd_invoice.id),
             order_id=rd_invoice.order_id,
             hd_invoice_id=None,
         )
-        logger.warning("Invoice %s descartada por walk-in", rd_invoice.order_id)
-        return
+        logger.warning("Invoice %s descartada: %s", rd_invoice.order_id, problem)
+        return None
+    rebu = CONFIG["used_goods_tax_class"] in map(lambda i: i.tax_class, rd_invoice.items)
 
     # --- Contacto ---
-    hd_contact = _sync_contact(convert_customer(rd_invoice.customer))
+    with tracing.span("contact"):
+        hd_contact = _sync_contact(convert_customer(rd_invoice.customer))
     if hd_contact is None or getattr(hd_contact, "id", None) is None:
         append_warning(
             message="failed: could not sync or find Holded contact",
@@ -172,14 +347,18 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
             hd_invoice_id=None,
         )
         logger.error("Invoice %s: contacto no disponible en Holded", rd_invoice.order_id)
-        return
+        return None
 
     # --- Buscar documento existente por número/cliente ---
-    found = find_holded_invoice_by_number(hd, hd_contact, rd_invoice.order_id)
+    # Con el mismo número con el que se crea, rellenado con ceros
+    number = into_numbering_series(int(rd_invoice.order_id))
+    with tracing.span("lookup"):
+        found = _find_holded_invoice(hd_contact, number)
 
     # --- ¿Borrador o aprobado? ---
     if rd_invoice.ticket is not None:
-        draft = any(d.status not in CLOSED_STATUS_LIST for d in rd_invoice.ticket.devices)
+        closed = closed_statuses.get()
+        draft = any(d.status not in closed for d in rd_invoice.ticket.devices)
     else:
         draft = bool(rebu)  # REBU en borrador, resto aprobado
 
@@ -187,6 +366,7 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
 
     # Helper: pagar según RD y, si RD=PAID, cerrar por diferencia exacta RD
     def _apply_payments_and_fix_with_rd(invoice_id: str):
+        nonlocal clean
         # 1) Pagos de RD (exactos, sin tolerancia)
         for payment in converted_hd_invoice.payments:
             hd.pay_document(converted_hd_invoice.type, invoice_id, payment)
@@ -210,6 +390,7 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
                         "Applied RD rounding fix %s to invoice %s", diff, rd_invoice.order_id
                     )
                 else:
+                    clean = False
                     append_warning(
                         order_id=rd_invoice.order_id,
                         rd_invoice_id=str(rd_invoice.id),
@@ -249,14 +430,21 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
         if mismatch:
             logger.info("Invoice %s is unsynced, reason: %s", rd_invoice.order_id, reason)
             try:
-                hd.delete_document(found)
-                new_id = hd.create_document(converted_hd_invoice, draft=draft)
-                _apply_payments_and_fix_with_rd(new_id)
+                with tracing.span("write"):
+                    hd.delete_document(found)
+                    invoices_index.remove(found.id)
+                    new_id = hd.create_document(converted_hd_invoice, draft=draft)
+                    invoices_index.put(dataclasses.replace(converted_hd_invoice, id=new_id))
+                history.count("written")
+                with tracing.span("payments"):
+                    _apply_payments_and_fix_with_rd(new_id)
                 if draft is False and CONFIG.get("send_email", False):
                     assert isinstance(converted_hd_invoice.buyer, holded.Contact)
                     send_to = converted_hd_invoice.buyer.email
                     if send_to:
-                        hd.send_document(converted_hd_invoice.type, new_id, send_to)
+                        with tracing.span("email"):
+                            hd.send_document(converted_hd_invoice.type, new_id, send_to)
+                return new_id if clean else None
             except holded.ApiError:
                 append_warning(
                     order_id=rd_invoice.order_id,
@@ -264,44 +452,63 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
                     rd_invoice_id=str(rd_invoice.id),
                     message="approved document is mismatched",
                 )
+                return None
         else:
             # Sin cambios de líneas: sincronizamos pagos que falten y aplicamos ajuste si procede
-            for rd_payment, hd_payment in itertools.zip_longest(
-                sorted(rd_invoice.payments, key=lambda p: p.date),
-                sorted(found.payments, key=lambda p: p.date),
-            ):
-                if hd_payment is None and rd_payment is not None:
-                    hd.pay_document(found.type, found.id, convert_payment(rd_payment))
-                    logger.info("Payed %s for invoice %s", rd_payment.amount, found.number)
-                elif rd_payment is None and hd_payment is not None:
-                    append_warning(
-                        order_id=rd_invoice.order_id,
-                        rd_invoice_id=str(rd_invoice.id),
-                        hd_invoice_id=found.id,
-                        message="missing payments in RepairDesk (payments deleted?)",
-                    )
-                elif rd_payment and hd_payment and abs(rd_payment.amount - hd_payment.amount) > TOL:
-                    append_warning(
-                        order_id=rd_invoice.order_id,
-                        rd_invoice_id=str(rd_invoice.id),
-                        hd_invoice_id=found.id,
-                        message="mismatched payment amount between Holded and RepairDesk",
-                    )
-
-            # Ajuste final con datos RD
-            _apply_payments_and_fix_with_rd(found.id)
+            with tracing.span("payments"):
+                for rd_payment, hd_payment in itertools.zip_longest(
+                    sorted(rd_invoice.payments, key=lambda p: p.date),
+                    sorted(found.payments, key=lambda p: p.date),
+                ):
+                    if hd_payment is None and rd_payment is not None:
+                        hd.pay_document(found.type, found.id, convert_payment(rd_payment))
+                        logger.info("Payed %s for invoice %s", rd_payment.amount, found.number)
+                    elif rd_payment is None and hd_payment is not None:
+                        clean = False
+                        append_warning(
+                            order_id=rd_invoice.order_id,
+                            rd_invoice_id=str(rd_invoice.id),
+                            hd_invoice_id=found.id,
+                            message="missing payments in RepairDesk (payments deleted?)",
+                        )
+                    elif (
+                        rd_payment
+                        and hd_payment
+                        and abs(rd_payment.amount - hd_payment.amount) > TOL
+                    ):
+                        clean = False
+                        append_warning(
+                            order_id=rd_invoice.order_id,
+                            rd_invoice_id=str(rd_invoice.id),
+                            hd_invoice_id=found.id,
+                            message="mismatched payment amount between Holded and RepairDesk",
+                        )
+
+                # Ajuste final con datos RD
+                _apply_payments_and_fix_with_rd(found.id)
+            return found.id if clean else None
 
     # --- No existe: crear (aprobada/borrador) ---
     else:
         try:
-            new_id = hd.create_document(converted_hd_invoice, draft=draft)
+            with tracing.span("write"):
+                try:
+                    new_id = hd.create_document(converted_hd_invoice, draft=draft)
+                except holded.RemoteUnavailable:
+                    # Puede haberse creado igualmente, se comprobará en Holded antes de reintentar
+                    invoices_index.mark_uncertain(number)
+                    raise
+                invoices_index.put(dataclasses.replace(converted_hd_invoice, id=new_id))
+            history.count("written")
             logger.info("Created %s %s", "DRAFT" if draft else "invoice", rd_invoice.order_id)
-            _apply_payments_and_fix_with_rd(new_id)
+            with tracing.span("payments"):
+                _apply_payments_and_fix_with_rd(new_id)
             if draft is False and CONFIG.get("send_email", False):
                 assert isinstance(converted_hd_invoice.buyer, holded.Contact)
                 send_to = converted_hd_invoice.buyer.email
                 if send_to:
-                    hd.send_document(converted_hd_invoice.type, new_id, send_to)
+                    with tracing.span("email"):
+                        hd.send_document(converted_hd_invoice.type, new_id, send_to)
 
             if draft and rebu:
                 append_warning(
@@ -321,6 +528,7 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
                     rd_invoice_id=str(rd_invoice.id),
                     order_id=rd_invoice.order_id,
                 )
+            return new_id if clean else None
         except holded.ApiError as e:
             logger.error("Error creando documento en Holded: %s", e)
             append_warning(
@@ -329,16 +537,42 @@ def _sync_invoice(rd_invoice: repairdesk.Invoice):
                 order_id=rd_invoice.order_id,
                 hd_invoice_id=None,
             )
+            return None
+
 
+# ---------- salud de las APIs ----------
+def breaker_states() -> dict[str, str]:
+    return {"repairdesk": rd.circuit_breaker.state, "holded": hd.circuit_breaker.state}
 
-# ---------- lotes de sincronización ----------
-def sync_new_invoices(exit_event: threading.Event):
-    logger.debug("Syncing new invoices")
+
+def metrics_snapshot() -> dict:
+    return {
+        "apis": {"repairdesk": rd.metrics.snapshot(), "holded": hd.metrics.snapshot()},
+        "gauges": {"circuit_open": {api: int(s == "open") for api, s in breaker_states().items()}},
+    }
+
+
+def unhealthy_for() -> float:
+    """
+    Segundos que faltan para que alguna API con el circuit breaker abierto vuelva a
+    aceptar llamadas, 0 si ambas están disponibles.
+    """
+    return max(rd.circuit_breaker.retry_in(), hd.circuit_breaker.retry_in())
+
+
+def _resume_from_holded() -> datetime:
+    """Fecha desde la que sincronizar según la última factura emitida en Holded"""
     try:
-        invoices_hd = hd.list_documents(
-            type=holded.DocumentType.INVOICE,
-            sort=holded.DocumentSort.CREATED_DESCENDING,
+        # Las últimas facturas creadas bastan para encontrar la de mayor número
+        invoices_hd = list(
+            hd.iter_documents(
+                type=holded.DocumentType.INVOICE,
+                sort=holded.DocumentSort.CREATED_DESCENDING,
+                limit=LAST_INVOICES_LOOKBEHIND,
+            )
         )
+    except holded.RemoteUnavailable:
+        raise
     except Exception as e:
         logger.error("Error listando facturas en Holded: %s", e)
         invoices_hd = []
@@ -347,39 +581,261 @@ def sync_new_invoices(exit_event: threading.Event):
     if not invoices_hd:
         from_dt = datetime.now() - timedelta(days=90)
         logger.info("No hay facturas en Holded; se sincroniza desde %s", from_dt)
-    else:
-        last_invoice = sorted(
-            filter(lambda i: i.status != holded.DocumentStatus.CANCELED, invoices_hd),
-            key=lambda d: from_numbering_series(d.number if d.number is not None else "0"),
-            reverse=True,
-        )[0]
-        from_dt = last_invoice.date
-        logger.info(
-            "Última factura en Holded fecha=%s número=%s", last_invoice.date, last_invoice.number
-        )
+        return from_dt
+
+    last_invoice = sorted(
+        filter(lambda i: i.status != holded.DocumentStatus.CANCELED, invoices_hd),
+        key=lambda d: from_numbering_series(d.number if d.number is not None else "0"),
+        reverse=True,
+    )[0]
+    logger.info(
+        "Última factura en Holded fecha=%s número=%s", last_invoice.date, last_invoice.number
+    )
+    return last_invoice.date
 
-    # Pedimos RD desde from_dt hasta ahora
-    for invoice in reversed(
-        rd.invoices(from_date=from_dt, to_date=datetime.now(), page_size=10000)
-    ):
-        if exit_event.is_set():
-            break
-        inv_full = rd.invoice_by_id(invoice.id)
-        _sync_invoice(inv_full)
 
+# ---------- cola de facturas ----------
+@dataclasses.dataclass(eq=False)
+class _Job:
+    history: history.JobRun
+    trace: tracing.Run
+    # Facturas de este trabajo todavía en la cola o sincronizándose
+    pending: int = 0
+    # Si sincronizar sus facturas avanza el checkpoint de sync_new_invoices
+    checkpoint: bool = False
 
-def sync_last_invoices(exit_event: threading.Event, time_before: timedelta):
-    from_date = max(
-        datetime.fromtimestamp(CONFIG.get("only_sync_later_than", 0)),
-        datetime.now() - time_before,
-    )
-    logger.debug("Checking invoices up to %s", from_date)
 
-    invoices = rd.invoices(from_date=from_date, page_size=10000)
-    for idx, invoice in enumerate(reversed(invoices)):
-        if exit_event.is_set():
-            logger.warning(
-                "Shutting down in the middle of an invoice check, %s/%s", idx, len(invoices)
+# Facturas pendientes de todos los trabajos; las nuevas van antes que las de las revisiones
+queue: WorkQueue[_Job] = WorkQueue()
+PRIORITY_NEW = 0
+
+
+def _rescan_priority(time_before: timedelta) -> int:
+    """Después de las nuevas, y entre revisiones la de ventana más corta primero"""
+    return 1 + time_before.days
+
+
+def _start_job(name: str, checkpoint: bool = False) -> _Job:
+    return _Job(history.start(name), tracing.start(name), checkpoint=checkpoint)
+
+
+@contextmanager
+def _in_job(job: _Job) -> Iterator[None]:
+    """Lo hecho dentro cuenta y se traza para `job`"""
+    with history.resume(job.history), tracing.resume(job.trace):
+        yield
+
+
+@contextmanager
+def _listing(job: _Job) -> Iterator[None]:
+    """Como `_in_job`, pero si falla el listado el trabajo termina sin encolar nada"""
+    try:
+        with _in_job(job):
+            yield
+    except Exception:
+        _finish(job)
+        raise
+
+
+def _finish(job: _Job):
+    history.finish(job.history)
+    tracing.finish(job.trace)
+
+
+def _release(job: _Job):
+    """Una factura de `job` ya no está pendiente, el trabajo termina con la última"""
+    job.pending -= 1
+    if job.pending == 0:
+        _finish(job)
+
+
+def _enqueue(job: _Job, invoices: Iterable[repairdesk.BasicInvoice], priority: int):
+    # Se cuenta como pendiente hasta terminar de encolar, así no termina a medias
+    job.pending += 1
+    for invoice in invoices:
+        queued, displaced = queue.put(invoice, priority, job)
+        if queued:
+            job.pending += 1
+        else:
+            job.history.deduplicated += 1
+        if displaced is not None:
+            displaced.history.deduplicated += 1
+            _release(displaced)
+    logger.debug("%s queued %s invoices, %s in queue", job.history.job, job.pending - 1, len(queue))
+    _release(job)
+
+
+def sync_new_invoices():
+    """Encola las facturas emitidas desde la última sincronizada, por delante de todo lo demás"""
+    job = _start_job("sync_new_invoices", checkpoint=True)
+    with _listing(job):
+        logger.debug("Listing new invoices")
+        last = checkpoints.load()
+        from_dt = last.date if last is not None else _resume_from_holded()
+        job.history.since = from_dt
+
+        # Pedimos RD desde from_dt hasta ahora
+        # RepairDesk lista de la más nueva a la más antigua, se sincronizan en orden de emisión
+        with tracing.span("list"):
+            invoices = list(
+                rd.iter_invoices(
+                    from_date=from_dt, to_date=datetime.now(), page_size=LIST_PAGE_SIZE, stream=True
+                )
+            )
+        invoices.reverse()
+        if last is not None:
+            # La del checkpoint (y las anteriores con la misma fecha) ya están sincronizadas
+            ids = [i.id for i in invoices]
+            if last.rd_invoice_id in ids:
+                invoices = invoices[ids.index(last.rd_invoice_id) + 1 :]
+    _enqueue(job, invoices, PRIORITY_NEW)
+
+
+def sync_last_invoices(time_before: timedelta):
+    """Encola para revisar las facturas de los últimos `time_before`"""
+    job = _start_job("sync_last_invoices")
+    with _listing(job):
+        from_date = max(
+            datetime.fromtimestamp(CONFIG.get("only_sync_later_than", 0)),
+            datetime.now() - time_before,
+        )
+        job.history.since = from_date
+        logger.debug("Listing invoices up to %s", from_date)
+
+        with tracing.span("list"):
+            invoices = list(
+                rd.iter_invoices(from_date=from_date, page_size=LIST_PAGE_SIZE, stream=True)
             )
-            break
-        _sync_invoice(rd.invoice_by_id(invoice.id))
+    _enqueue(job, reversed(invoices), _rescan_priority(time_before))
+
+
+def sync_queued(exit_event: threading.Event, stop: Callable[[], bool]):
+    """
+    Sincroniza las facturas encoladas por orden de prioridad hasta vaciar la cola o que
+    `stop()` lo pida (por ejemplo para encolar las de un trabajo que toca ya); lo ya
+    empezado se termina antes de volver.
+
+    Cada factura pasa por tres etapas unidas por colas de PIPELINE_QUEUE_SIZE: el detalle
+    en RepairDesk (FETCH_WORKERS a la vez), la búsqueda de su contacto en Holded
+    (CONTACT_WORKERS a la vez) y la escritura en Holded. Esta última va de una en una y en
+    orden, para que el checkpoint solo avance y no se dupliquen contactos nuevos. Mientras
+    se escribe una factura ya se piden las siguientes, el ritmo lo marca la API más lenta.
+    """
+    if not len(queue):
+        return
+    tickets.closed_statuses = closed_statuses.get()
+    contacts.ensure_loaded()
+    # Las búsquedas sin resultado solo se recuerdan entre etapas de la misma pasada
+    contacts.clear_missed()
+    asyncio.run(_pipeline(exit_event, stop))
+
+
+@dataclasses.dataclass
+class _Item:
+    seq: int
+    entry: Entry[_Job]
+    invoice: repairdesk.Invoice | None = None
+    # Falló alguna etapa, se descarta sin escribirla
+    failed: bool = False
+
+
+async def _pipeline(exit_event: threading.Event, stop: Callable[[], bool]):
+    to_fetch: asyncio.Queue[_Item | None] = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    to_resolve: asyncio.Queue[_Item | None] = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    to_write: asyncio.Queue[_Item | None] = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    # Sacadas de la cola y sin terminar, vuelven a ella si el pipeline se interrumpe
+    started: dict[int, _Item] = {}
+    lookups: dict[str, asyncio.Task[holded.Contact | None]] = {}
+
+    async def produce():
+        for seq in itertools.count():
+            if exit_event.is_set() or stop():
+                break
+            popped = queue.pop(1)
+            if not popped:
+                break
+            started[seq] = _Item(seq, popped[0])
+            await to_fetch.put(started[seq])
+        for _ in range(FETCH_WORKERS):
+            await to_fetch.put(None)
+
+    async def stage(workers: int, work, inbox: asyncio.Queue, outbox: asyncio.Queue, after: int):
+        # `workers` tareas hacen `work` con lo que llega hasta recibir una marca de fin cada
+        # una; entonces se pasa una marca a cada una de las `after` de la etapa siguiente
+        async def worker():
+            while (item := await inbox.get()) is not None:
+                if not item.failed:
+                    await work(item)
+                await outbox.put(item)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        for _ in range(after):
+            await outbox.put(None)
+
+    async def fetch(item: _Item):
+        try:
+            with _in_job(item.entry.owner):
+                with tracing.span("fetch"):
+                    invoice = await ard.invoice_by_id(item.entry.invoice.id, include_ticket=False)
+                # El ticket solo decide si va en borrador, las que se van a descartar no lo piden
+                if invoice.ticket_id is not None and _sanity_problem(invoice) is None:
+                    with tracing.span("ticket"):
+                        invoice.ticket = await ard.ticket_by_id(invoice.ticket_id)
+                item.invoice = invoice
+        except (repairdesk.RemoteUnavailable, holded.RemoteUnavailable):
+            raise
+        except Exception:
+            logger.exception("Could not fetch invoice %s", item.entry.invoice.order_id)
+            item.failed = True
+
+    async def resolve(item: _Item):
+        assert item.invoice is not None
+        with _in_job(item.entry.owner), tracing.span("resolve_contact"):
+            await _resolve_contact(item.invoice, lookups)
+
+    async def write():
+        # Llegan desordenadas de las etapas anteriores, se escriben por orden de cola
+        arrived: dict[int, _Item] = {}
+        next_seq = 0
+        while (item := await to_write.get()) is not None:
+            arrived[item.seq] = item
+            while next_seq in arrived:
+                item = arrived.pop(next_seq)
+                next_seq += 1
+                if exit_event.is_set():
+                    continue  # Se queda en `started` y vuelve a la cola
+                if not item.failed:
+                    await asyncio.to_thread(_write, item)
+                del started[item.seq]
+                queue.done(item.entry)
+                _release(item.entry.owner)
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(produce())
+            tg.create_task(stage(FETCH_WORKERS, fetch, to_fetch, to_resolve, CONTACT_WORKERS))
+            tg.create_task(stage(CONTACT_WORKERS, resolve, to_resolve, to_write, 1))
+            tg.create_task(write())
+    except ExceptionGroup as group:
+        # Se propaga el primer fallo tal cual (una API no disponible)
+        raise group.exceptions[0]
+    finally:
+        if exit_event.is_set() and started:
+            logger.warning("Shutting down with %s invoices in queue", len(queue) + len(started))
+        for seq in sorted(started):
+            queue.requeue(started[seq].entry)
+
+
+def _write(item: _Item):
+    """Sincroniza con Holded una factura ya pedida, los fallos que no son de API se registran"""
+    assert item.invoice is not None
+    inv_full = item.invoice
+    try:
+        with _in_job(item.entry.owner):
+            _sync_invoice(inv_full)
+            if item.entry.owner.checkpoint:
+                checkpoints.save(Checkpoint(str(inv_full.id), inv_full.order_id, inv_full.date))
+    except (repairdesk.RemoteUnavailable, holded.RemoteUnavailable):
+        raise
+    except Exception:
+        logger.exception("Could not sync invoice %s", inv_full.order_id)
@@ -0,0 +1,57 @@
+# Durable record of the last RepairDesk invoice synced by `sync_new_invoices`, stored as JSON under
+# `data_dir`
+#
+# Lets the new invoice sync resume from where it stopped without asking Holded for its latest
+# invoices. The file is replaced atomically so a crash mid-write leaves the previous checkpoint in
+# place; a missing or unreadable file just means falling back to the Holded scan.
+
+from dataclasses import dataclass
+from datetime import datetime
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Checkpoint:
+    rd_invoice_id: str
+    order_id: str
+    date: datetime
+
+
+class CheckpointStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Checkpoint | None:
+        """Last checkpoint saved, None if there is none or it can't be read"""
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+            return Checkpoint(
+                rd_invoice_id=str(raw["rd_invoice_id"]),
+                order_id=str(raw["order_id"]),
+                date=datetime.fromisoformat(raw["date"]),
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring damaged sync checkpoint %s: %s", self.path, e)
+            return None
+
+    def save(self, checkpoint: Checkpoint):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "rd_invoice_id": checkpoint.rd_invoice_id,
+                    "order_id": checkpoint.order_id,
+                    "date": checkpoint.date.isoformat(),
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
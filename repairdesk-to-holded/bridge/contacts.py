@@ -0,0 +1,145 @@
+# In-memory index of Holded contacts, keyed by customId and mobile
+#
+# Most invoices belong to returning customers, looking them up here saves the Holded round-trips
+# `_sync_contact` would otherwise make for every invoice. The index is bulk-loaded on first use,
+# reloaded once it gets older than `max_age` (picks up edits made in Holded itself), filled in on
+# misses with a regular API lookup and kept up to date with the bridge's own creates/updates.
+# Lookups that found nothing are remembered until `clear_missed`, which the bridge calls at the
+# start of each sync so a new customer is looked up once per sync even if several stages ask.
+
+from datetime import datetime, timedelta
+import logging
+import threading
+
+import holded
+
+logger = logging.getLogger(__name__)
+
+
+class ContactIndex:
+    def __init__(self, hd: holded.Holded, max_age: timedelta):
+        self.hd = hd
+        self.max_age = max_age
+        self._by_id: dict[str, holded.Contact] = {}
+        self._by_custom_id: dict[str, holded.Contact] = {}
+        self._by_mobile: dict[str, holded.Contact] = {}
+        # customIds and mobiles Holded had no contact for
+        self._missing: set[tuple[str, str]] = set()
+        self._loaded_at: datetime | None = None
+        self._lock = threading.Lock()
+        # Held while loading, a single load runs at a time
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        start = datetime.now()
+        by_id = {}
+        by_custom_id = {}
+        by_mobile = {}
+        for contact in self.hd.iter_contacts():
+            by_id[contact.id] = contact
+            if contact.custom_id:
+                by_custom_id[contact.custom_id] = contact
+            if contact.mobile:
+                by_mobile[contact.mobile] = contact
+
+        with self._lock:
+            self._by_id = by_id
+            self._by_custom_id = by_custom_id
+            self._by_mobile = by_mobile
+            self._missing = set()
+            self._loaded_at = start
+        logger.info(
+            "Loaded %s Holded contacts in %.1fs",
+            len(by_id),
+            (datetime.now() - start).total_seconds(),
+        )
+
+    def _stale(self) -> bool:
+        return self._loaded_at is None or datetime.now() - self._loaded_at > self.max_age
+
+    def ensure_loaded(self):
+        """Loads the index if it never was or has got older than `max_age`"""
+        if not self._stale():
+            return
+        with self._load_lock:
+            # Someone else may have loaded it while waiting
+            if self._stale():
+                self.load()
+
+    def cached(self, contact: holded.Contact) -> holded.Contact | None:
+        """Looks up `contact` by customId, then mobile, without calling Holded on a miss"""
+        self.ensure_loaded()
+        with self._lock:
+            found = None
+            if contact.custom_id is not None:
+                found = self._by_custom_id.get(contact.custom_id)
+            if found is None and contact.mobile is not None:
+                found = self._by_mobile.get(contact.mobile)
+            return found
+
+    def get(self, contact: holded.Contact) -> holded.Contact | None:
+        """
+        Same as `cached` but asks Holded on a miss, remembering what it finds. Whether it finds
+        nothing is remembered too, unless a lookup failed.
+        """
+        found = self.cached(contact)
+        if found is not None:
+            return found
+
+        with self._lock:
+            missing = set(self._missing)
+        failed = False
+        for field, value in (("custom_id", contact.custom_id), ("mobile", contact.mobile)):
+            if value is None or (field, value) in missing:
+                continue
+            try:
+                found = next(iter(self.hd.search_contacts(**{field: value})), None)
+            except holded.RemoteUnavailable:
+                raise
+            except Exception as e:
+                logger.warning("Looking up contact by %s %s failed: %s", field, value, e)
+                failed = True
+                continue
+            if found is not None:
+                self.put(found)
+                return found
+        if not failed:
+            self.missed(contact)
+        return None
+
+    def missed(self, contact: holded.Contact):
+        """Records that Holded has no contact with `contact`'s customId or mobile"""
+        with self._lock:
+            if contact.custom_id is not None:
+                self._missing.add(("custom_id", contact.custom_id))
+            if contact.mobile is not None:
+                self._missing.add(("mobile", contact.mobile))
+
+    def clear_missed(self, contact: holded.Contact | None = None):
+        """
+        Forgets that Holded had no contact with `contact`'s customId or mobile, or every
+        contact's if None, so they are looked up again
+        """
+        with self._lock:
+            if contact is None:
+                self._missing = set()
+                return
+            self._missing.discard(("custom_id", contact.custom_id))
+            self._missing.discard(("mobile", contact.mobile))
+
+    def put(self, contact: holded.Contact):
+        """Adds or replaces `contact`, which must have been created or updated in Holded"""
+        assert contact.id is not None
+        with self._lock:
+            # Drop the entries of the previous version, its mobile may have changed
+            previous = self._by_id.get(contact.id)
+            if previous is not None:
+                if self._by_custom_id.get(previous.custom_id) is previous:
+                    del self._by_custom_id[previous.custom_id]
+                if self._by_mobile.get(previous.mobile) is previous:
+                    del self._by_mobile[previous.mobile]
+            self._by_id[contact.id] = contact
+            if contact.custom_id:
+                self._by_custom_id[contact.custom_id] = contact
+            if contact.mobile:
+                self._by_mobile[contact.mobile] = contact
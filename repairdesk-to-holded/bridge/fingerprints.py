@@ -0,0 +1,97 @@
+# Content fingerprints of the RepairDesk invoices already synced, stored in SQLite under `data_dir`
+#
+# Rescans fetch every invoice in their window again, but most of them haven't changed since they
+# were last synced. Each invoice that reached a consistent state in Holded is recorded with a hash
+# of the content the sync depends on and the Holded document it ended up as, so unchanged invoices
+# can be skipped without any Holded call.
+
+from dataclasses import dataclass
+import hashlib
+import json
+import sqlite3
+import threading
+
+import repairdesk
+
+# Bump when the conversion to Holded changes, so every invoice is synced again
+FINGERPRINT_VERSION = 1
+
+
+def fingerprint(invoice: repairdesk.Invoice) -> str:
+    """Stable hash of everything in `invoice` that ends up in (or decides) its Holded document"""
+    content = {
+        "version": FINGERPRINT_VERSION,
+        "order_id": invoice.order_id,
+        "date": invoice.date,
+        "subtotal": invoice.subtotal,
+        "total_tax": invoice.total_tax,
+        "total": invoice.total,
+        "notes": invoice.notes,
+        "status": invoice.status.value if invoice.status is not None else None,
+        "customer": [
+            invoice.customer.id,
+            invoice.customer.full_name,
+            invoice.customer.address,
+            invoice.customer.mobile,
+            invoice.customer.email,
+            invoice.customer.city,
+            invoice.customer.state,
+            invoice.customer.country,
+            invoice.customer.postcode,
+            invoice.customer.nif,
+            invoice.customer.customer_group_id,
+        ],
+        "items": [
+            [i.id, i.name, i.sku, i.quantity, i.price, i.tax, i.total, i.tax_class, i.tax_percent]
+            for i in invoice.items
+        ],
+        "payments": [[p.id, p.amount, p.date, p.method] for p in invoice.payments],
+        # Decide whether the invoice is a draft
+        "devices": (
+            [[d.id, d.status] for d in invoice.ticket.devices]
+            if invoice.ticket is not None
+            else None
+        ),
+    }
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+@dataclass
+class SyncedInvoice:
+    rd_invoice_id: str
+    fingerprint: str
+    hd_invoice_id: str
+
+
+class FingerprintStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            " rd_invoice_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL,"
+            " hd_invoice_id TEXT NOT NULL)"
+        )
+
+    def get(self, rd_invoice_id: str) -> SyncedInvoice | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT rd_invoice_id, fingerprint, hd_invoice_id FROM fingerprints"
+                " WHERE rd_invoice_id = ?",
+                (rd_invoice_id,),
+            ).fetchone()
+        return SyncedInvoice(*row) if row is not None else None
+
+    def put(self, synced: SyncedInvoice):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fingerprints (rd_invoice_id, fingerprint, hd_invoice_id)"
+                " VALUES (?, ?, ?)",
+                (synced.rd_invoice_id, synced.fingerprint, synced.hd_invoice_id),
+            )
+
+    def remove(self, rd_invoice_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM fingerprints WHERE rd_invoice_id = ?", (rd_invoice_id,))
@@ -0,0 +1,172 @@
+# Local index of the invoices in Holded, stored in SQLite under `data_dir`
+#
+# Maps each invoice number to its Holded document id, contact, status and total, so finding the
+# Holded counterpart of a RepairDesk invoice is a local lookup instead of paging through the
+# contact's invoices. The index is kept up to date with the bridge's own creates/deletes, with a
+# frequent incremental load of recent invoices and a periodic full reload (which also forgets
+# invoices deleted in Holded). Numbers whose create failed without an answer from Holded are
+# marked uncertain: the invoice may exist without being indexed, so a miss has to be checked
+# against Holded itself.
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+import logging
+import sqlite3
+import threading
+
+import holded
+
+logger = logging.getLogger(__name__)
+
+# Incremental loads look this far before the previous one, invoices are often dated in the past
+REFRESH_OVERLAP = timedelta(days=1)
+# Bumped when stored rows change meaning, older indexes are fully reloaded
+INDEX_VERSION = 1
+
+
+@dataclass
+class IndexedInvoice:
+    number: str
+    id: str
+    contact_id: str | None
+    status: holded.DocumentStatus | None
+    total: Decimal | None
+
+
+class InvoiceIndex:
+    def __init__(self, hd: holded.Holded, path: str, full_reload: timedelta, refresh: timedelta):
+        self.hd = hd
+        self.full_reload = full_reload
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS invoices ("
+            " number TEXT PRIMARY KEY, id TEXT NOT NULL, contact_id TEXT,"
+            " status INTEGER, total TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS invoices_id ON invoices (id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS uncertain (number TEXT PRIMARY KEY)")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] < INDEX_VERSION:
+            # Numbers used to be stored without leading zeros, a full reload stores them as they are
+            self._db.execute("DELETE FROM meta WHERE key = 'last_full_load'")
+            self._db.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+
+    def _meta(self, key: str) -> datetime | None:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row is not None else None
+
+    def _set_meta(self, key: str, value: datetime):
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value.isoformat())
+        )
+
+    def _store(self, doc: holded.Document):
+        if doc.status == holded.DocumentStatus.CANCELED:
+            self._db.execute("DELETE FROM invoices WHERE id = ?", (doc.id,))
+            return
+        if doc.number is None:
+            # Holded may return documents without a number, no RepairDesk invoice can match them
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO invoices (number, id, contact_id, status, total)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                doc.number,
+                doc.id,
+                doc.buyer.id if isinstance(doc.buyer, holded.Contact) else doc.buyer,
+                doc.status.value if doc.status is not None else None,
+                str(doc.total) if doc.total is not None else None,
+            ),
+        )
+
+    def load(self, start: datetime | None = None):
+        """Loads every invoice dated after `start` from Holded, all of them replacing the index
+        when `start` is None"""
+        now = datetime.now()
+        docs = list(self.hd.iter_documents(type=holded.DocumentType.INVOICE, start=start))
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                if start is None:
+                    self._db.execute("DELETE FROM invoices")
+                for doc in docs:
+                    self._store(doc)
+                self._set_meta("last_refresh", now)
+                if start is None:
+                    self._set_meta("last_full_load", now)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        logger.info(
+            "Loaded %s Holded invoices (%s) in %.1fs",
+            len(docs),
+            "full" if start is None else "since {}".format(start),
+            (datetime.now() - now).total_seconds(),
+        )
+
+    def _ensure_fresh(self):
+        with self._lock:
+            last_full_load = self._meta("last_full_load")
+            last_refresh = self._meta("last_refresh")
+        now = datetime.now()
+        if last_full_load is None or now - last_full_load > self.full_reload:
+            self.load()
+        elif last_refresh is None or now - last_refresh > self.refresh:
+            self.load(start=(last_refresh or last_full_load) - REFRESH_OVERLAP)
+
+    def find(self, contact_id: str, number: str) -> IndexedInvoice | None:
+        """The non-canceled invoice with `number` issued to `contact_id`, if any"""
+        self._ensure_fresh()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT number, id, contact_id, status, total FROM invoices"
+                " WHERE number = ? AND contact_id = ?",
+                (number, contact_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return IndexedInvoice(
+            number=row[0],
+            id=row[1],
+            contact_id=row[2],
+            status=holded.DocumentStatus(row[3]) if row[3] is not None else None,
+            total=Decimal(row[4]) if row[4] is not None else None,
+        )
+
+    def put(self, doc: holded.Document):
+        """Records a document the bridge has just created (or fetched) in Holded"""
+        assert doc.id is not None
+        with self._lock:
+            self._store(doc)
+
+    def mark_uncertain(self, number: str):
+        """Records that creating invoice `number` failed in a way it may have been created anyway"""
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO uncertain (number) VALUES (?)", (number,))
+
+    def is_uncertain(self, number: str) -> bool:
+        """Whether a miss for `number` may be an invoice created but not indexed"""
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM uncertain WHERE number = ?", (number,)).fetchone()
+        return row is not None
+
+    def settle(self, number: str):
+        """Records that Holded has been asked for invoice `number`, whatever the answer"""
+        with self._lock:
+            self._db.execute("DELETE FROM uncertain WHERE number = ?", (number,))
+
+    def remove(self, id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM invoices WHERE id = ?", (id,))
+
+    def contains(self, id: str) -> bool:
+        """Whether the Holded document `id` still exists, as of the last load"""
+        self._ensure_fresh()
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM invoices WHERE id = ?", (id,)).fetchone()
+        return row is not None
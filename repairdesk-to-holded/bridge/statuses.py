@@ -0,0 +1,75 @@
+# Names of the RepairDesk ticket statuses in the "Closed" category
+#
+# Fetched on first use instead of at import, so starting the bridge doesn't depend on RepairDesk
+# being reachable. The list is kept on disk under `data_dir` and refreshed periodically; when
+# RepairDesk can't be reached the last known list is used, however old.
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import threading
+from time import monotonic
+
+import repairdesk
+
+logger = logging.getLogger(__name__)
+
+# After a failed refresh the cached list is used for this long before trying again
+RETRY_FAILED_REFRESH = timedelta(minutes=5)
+
+
+class ClosedStatuses:
+    def __init__(self, rd: repairdesk.RepairDesk, path: str, refresh: timedelta):
+        self.rd = rd
+        self.path = path
+        self.refresh = refresh
+        self._names: set[str] | None = None
+        self._fetched: datetime | None = None
+        self._next_refresh: datetime | None = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+            self._names = set(raw["closed"])
+            self._fetched = datetime.fromisoformat(raw["fetched"])
+            self._next_refresh = self._fetched + self.refresh
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring damaged ticket status cache %s: %s", self.path, e)
+
+    def _write(self):
+        assert self._names is not None and self._fetched is not None
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"fetched": self._fetched.isoformat(), "closed": sorted(self._names)}, f)
+        os.replace(tmp, self.path)
+
+    def _fetch(self):
+        start = monotonic()
+        statuses = self.rd.ticket_statuses()
+        self._names = {s.name for s in statuses if s.type == "Closed"}
+        self._fetched = datetime.now()
+        self._next_refresh = self._fetched + self.refresh
+        self._write()
+        logger.info(
+            "Fetched %s closed ticket statuses in %.2fs", len(self._names), monotonic() - start
+        )
+
+    def get(self) -> set[str]:
+        with self._lock:
+            if self._names is None:
+                self._read()
+            if self._next_refresh is None or datetime.now() >= self._next_refresh:
+                try:
+                    self._fetch()
+                except Exception as e:
+                    if self._names is None:
+                        raise
+                    logger.warning("Could not refresh ticket statuses, using cached ones: %s", e)
+                    self._next_refresh = datetime.now() + RETRY_FAILED_REFRESH
+            assert self._names is not None
+            return self._names
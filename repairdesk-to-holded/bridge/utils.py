@@ -2,23 +2,20 @@
 
 
 from dataclasses import dataclass
-import dataclasses
 from datetime import datetime, timedelta
 import holded
 import repairdesk
-import json
 from decimal import Decimal
-from server import warnings_lock
 import logging
-from uuid import uuid4
-from server import Warning
 import os
 import re
+import history
+import runtime
+import warnings_store
 
 logger = logging.getLogger(__name__)
 
-# Importing twice is pretty bad...
-CONFIG = json.load(open("/etc/repairdesk-to-holded.conf.json"))
+CONFIG = runtime.config()
 
 # ---------------------------------------------------------------------
 # BÚSQUEDAS Y AVISOS
@@ -77,65 +74,10 @@ def find_holded_invoice_by_number(
 def append_warning(
     message: str, order_id: str, hd_invoice_id: str | None, rd_invoice_id: str | None
 ):
-    # TODO: if a invoice is already affected, stack messages
-    with warnings_lock:
-        # TODO: wrong paths are not handled...
-        try:
-            with open(CONFIG["data_dir"].rstrip("/") + "/warnings.json") as warn_file:
-                warns = list(
-                    map(
-                        lambda w: Warning(
-                            id=w["id"],
-                            messages=w["messages"],
-                            hd_invoice_id=w["hd_invoice_id"],
-                            rd_invoice_id=w["rd_invoice_id"],
-                            order_id=w["order_id"],
-                        ),
-                        json.load(warn_file),
-                    )
-                )
-        except FileNotFoundError:
-            warns = []
-
-        # Find index of existing warning or None
-        if hd_invoice_id is not None and rd_invoice_id is not None:
-            idx = next(
-                (
-                    i
-                    for i, w in enumerate(warns)
-                    if (w.rd_invoice_id == rd_invoice_id) and (w.hd_invoice_id == hd_invoice_id)
-                ),
-                None,
-            )
-        elif hd_invoice_id is not None:
-            idx = next(
-                (i for i, w in enumerate(warns) if (w.hd_invoice_id == hd_invoice_id)),
-                None,
-            )
-        elif rd_invoice_id is not None:
-            idx = next(
-                (i for i, w in enumerate(warns) if (w.rd_invoice_id == rd_invoice_id)),
-                None,
-            )
-        else:
-            idx = None
-
-        if idx is not None:
-            if message not in warns[idx].messages:
-                warns[idx].messages.append(message)
-        else:
-            warns.append(
-                Warning(
-                    id=str(uuid4()),
-                    messages=[message],
-                    hd_invoice_id=hd_invoice_id,
-                    rd_invoice_id=rd_invoice_id,
-                    order_id=order_id,
-                )
-            )
-
-        with open(CONFIG["data_dir"].rstrip("/") + "/warnings.json", "w") as warn_file:
-            json.dump(list(map(dataclasses.asdict, warns)), warn_file)
+    warnings_store.store().append(
+        message, order_id=order_id, hd_invoice_id=hd_invoice_id, rd_invoice_id=rd_invoice_id
+    )
+    history.count("errors")
 
 
 # ---------------------------------------------------------------------
@@ -0,0 +1,83 @@
+# Invoices waiting to be synced, in priority order, each one at most once
+#
+# Sync jobs only list the invoices in their window and queue them; they are synced from here a
+# batch at a time, lowest priority value first and in queuing order within a priority. An invoice
+# queued again while still waiting keeps a single entry, moved ahead if the new priority is better;
+# one already taken out to be synced is not queued again.
+
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import threading
+from typing import Generic, TypeVar
+
+import repairdesk
+
+T = TypeVar("T")
+
+
+@dataclass(order=True)
+class Entry(Generic[T]):
+    priority: int
+    seq: int
+    invoice: repairdesk.BasicInvoice = field(compare=False)
+    # Whoever queued the invoice with the best priority, it is synced on its behalf
+    owner: T = field(compare=False)
+
+
+class WorkQueue(Generic[T]):
+    def __init__(self):
+        self._heap: list[Entry[T]] = []
+        # Current entry of each queued invoice, entries left in the heap by a move are stale
+        self._queued: dict[str, Entry[T]] = {}
+        self._in_flight: set[str] = set()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._queued)
+
+    def put(
+        self, invoice: repairdesk.BasicInvoice, priority: int, owner: T
+    ) -> tuple[bool, T | None]:
+        """
+        Queues `invoice` for `owner`. Returns whether it was queued for `owner` and, when it was
+        already waiting with a worse priority, the owner it was taken from. Invoices already
+        waiting with the same or a better priority, or being synced, are left alone.
+        """
+        with self._lock:
+            if invoice.id in self._in_flight:
+                return False, None
+            previous = self._queued.get(invoice.id)
+            if previous is not None and previous.priority <= priority:
+                return False, None
+            entry = Entry(priority, next(self._seq), invoice, owner)
+            self._queued[invoice.id] = entry
+            heapq.heappush(self._heap, entry)
+            return True, previous.owner if previous is not None else None
+
+    def pop(self, n: int) -> list[Entry[T]]:
+        """Takes out up to `n` invoices to be synced, they count as in flight until `done`"""
+        with self._lock:
+            batch = []
+            while self._heap and len(batch) < n:
+                entry = heapq.heappop(self._heap)
+                if self._queued.get(entry.invoice.id) is not entry:
+                    continue
+                del self._queued[entry.invoice.id]
+                self._in_flight.add(entry.invoice.id)
+                batch.append(entry)
+            return batch
+
+    def done(self, entry: Entry[T]):
+        with self._lock:
+            self._in_flight.discard(entry.invoice.id)
+
+    def requeue(self, entry: Entry[T]):
+        """Puts back an invoice taken out but not synced, in its old place"""
+        with self._lock:
+            self._in_flight.discard(entry.invoice.id)
+            if entry.invoice.id not in self._queued:
+                self._queued[entry.invoice.id] = entry
+                heapq.heappush(self._heap, entry)
@@ -1,11 +1,18 @@
-import bridge
 from datetime import timedelta, datetime
 import threading
 import schedule
 import logging
-import json
-from server import shared_dict, shared_lock
+import metrics
+import runtime
+import logfile
 
+logfile.setup()
+
+import bridge  # noqa: E402  (logs while being imported)
+
+
+# Threads per worker, so a browser following /logs/stream doesn't block the rest of the UI
+threads = 8
 
 TIME_BETWEEN_LOOPS = 60
 exit_event = threading.Event()
@@ -13,72 +20,110 @@ logger = logging.getLogger(__name__)
 
 
 def run_sync(exit_event: threading.Event):
+    shared = runtime.shared()
+
+    # Jobs only list their invoices and queue them, they are synced below by priority: new ones
+    # first, then the rescans with the shortest window. An invoice is queued only once
+
     # New invoices only
-    schedule.every(1).minutes.do(bridge.sync_new_invoices, exit_event=exit_event)
+    schedule.every(1).minutes.do(bridge.sync_new_invoices)
 
     # Every 30 minuts check the day
     schedule.every(30).minutes.do(
         bridge.sync_last_invoices,
-        exit_event=exit_event,
         time_before=timedelta(seconds=0),  # Seconds = 0 because RepairDesk truncates to current day
     )
 
     # Weekdays daily job
     schedule.every().monday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
     schedule.every().tuesday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
     schedule.every().wednesday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
     schedule.every().thursday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
     schedule.every().friday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
     schedule.every().saturday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(weeks=1)
+        bridge.sync_last_invoices, time_before=timedelta(weeks=1)
     )
 
     # Sunday check 4 months
     schedule.every().sunday.at("08:00").do(
-        bridge.sync_last_invoices, exit_event=exit_event, time_before=timedelta(days=30 * 4)
+        bridge.sync_last_invoices, time_before=timedelta(days=30 * 4)
     )
 
     while True:
+        # Skip the cycle while an API is known to be down, jobs stay due and run once it is back
+        if (retry_in := bridge.unhealthy_for()) > 0:
+            logger.warning("Remote API unavailable, skipping sync for %.0fs", retry_in)
+            with shared.lock:
+                shared.state["state"] = "remote unavailable"
+                shared.state["breakers"] = bridge.breaker_states()
+                shared.state["next_loop"] = (
+                    datetime.now() + timedelta(seconds=retry_in)
+                ).timestamp()
+            if exit_event.wait(timeout=retry_in):
+                break
+            continue
+
         start = datetime.now()
 
-        with shared_lock:
-            shared_dict["state"] = "running"
+        with shared.lock:
+            shared.state["state"] = "running"
 
         try:
             schedule.run_pending()
+            # Stops taking invoices when a job is due, so new ones don't wait for a rescan
+            bridge.sync_queued(exit_event, stop=lambda: schedule.idle_seconds() <= 0)
         except Exception as e:
             logger.error("{}".format(e))
-            with shared_lock:
-                shared_dict["state"] = "failed"
+            with shared.lock:
+                shared.state["state"] = "failed"
 
         end = datetime.now()
 
-        with shared_lock:
-            shared_dict["last_run"] = (end - start).total_seconds()
-            shared_dict["state"] = "waiting for next loop"
-            shared_dict["next_loop"] = (
+        with shared.lock:
+            shared.state["last_run"] = (end - start).total_seconds()
+            shared.state["state"] = "waiting for next loop"
+            shared.state["breakers"] = bridge.breaker_states()
+            shared.state["queued"] = len(bridge.queue)
+            shared.state["next_loop"] = (
                 end + timedelta(seconds=schedule.idle_seconds())
             ).timestamp()
 
-        if exit_event.wait(timeout=max(0, schedule.idle_seconds())):
+        # Straight on while invoices are left in the queue
+        wait = 0 if len(bridge.queue) else max(0, schedule.idle_seconds())
+        if exit_event.wait(timeout=wait):
             break
 
 
 def on_starting(server):
     global exit_event
 
+    # Started here so the workers forked afterwards share it with the sync thread
+    runtime.shared()
     sync_worker = threading.Thread(target=run_sync, args=(exit_event,))
     sync_worker.start()
+    threading.Thread(
+        target=metrics.publish_forever,
+        args=(exit_event, "sync", bridge.metrics_snapshot),
+        daemon=True,
+    ).start()
+
+
+def when_ready(server):
+    startup = runtime.since_start()
+    shared = runtime.shared()
+    with shared.lock:
+        shared.state["startup"] = startup
+    server.log.info("Ready {:.2f}s after loading the configuration".format(startup))
 
 
 def on_exit(server):
@@ -0,0 +1,97 @@
+# History of the sync jobs run by the scheduler, shown in /status
+#
+# Each job run is counted while it goes (invoices scanned, written to Holded, skipped as unchanged,
+# left to another job, errors) and, once all its invoices are synced, appended to a list in the
+# shared Manager so the workers can show it.
+# Only the last HISTORY_SIZE runs are kept, enough to compare throughput over several days.
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from datetime import datetime
+import threading
+from typing import Any
+
+import runtime
+
+# Job runs kept, a few days of the every minute job plus the rescans
+HISTORY_SIZE = 5000
+
+
+@dataclass
+class JobRun:
+    job: str
+    start: datetime
+    end: datetime | None = None
+    # Oldest invoice date the job looked at
+    since: datetime | None = None
+    scanned: int = 0
+    written: int = 0
+    skipped: int = 0
+    # Listed by this job but synced for another one that had queued them with a better priority
+    deduplicated: int = 0
+    errors: int = 0
+    api_calls: int = 0
+
+    def to_json(self) -> dict[str, Any]:
+        return asdict(self) | {
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat() if self.end is not None else None,
+            "since": self.since.isoformat() if self.since is not None else None,
+            "duration": (self.end - self.start).total_seconds() if self.end is not None else None,
+        }
+
+
+_current: ContextVar[JobRun | None] = ContextVar("job_run", default=None)
+# Counters are updated from the threads of every stage of the sync pipeline
+_lock = threading.Lock()
+
+
+def start(name: str) -> JobRun:
+    """A new run of job `name`, counted inside `resume` and recorded by `finish`"""
+    return JobRun(job=name, start=datetime.now())
+
+
+@contextmanager
+def resume(run: JobRun) -> Iterator[None]:
+    """Counts what is done inside for `run`, including threads started with its context"""
+    token = _current.set(run)
+    try:
+        yield
+    except Exception:
+        count("errors")
+        raise
+    finally:
+        _current.reset(token)
+
+
+def finish(run: JobRun):
+    run.end = datetime.now()
+    _record(run)
+
+
+def count(field: str, n: int = 1):
+    """
+    Adds `n` to a counter (scanned, written, skipped, deduplicated, errors, api_calls) of the job
+    resumed, if any
+    """
+    current = _current.get()
+    if current is not None:
+        with _lock:
+            setattr(current, field, getattr(current, field) + n)
+
+
+def _record(run: JobRun):
+    history = runtime.shared().history
+    history.append(run.to_json())
+    if len(history) > HISTORY_SIZE:
+        del history[:-HISTORY_SIZE]
+
+
+def last(limit: int = HISTORY_SIZE) -> list[dict[str, Any]]:
+    """The last `limit` job runs, newest first"""
+    # Sliced in the Manager, only the runs asked for are sent over
+    runs = runtime.shared().history[-limit:] if limit > 0 else []
+    runs.reverse()
+    return runs
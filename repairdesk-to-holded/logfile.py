@@ -0,0 +1,176 @@
+# The bridge's log file, as written by the sync thread and read by the /logs pages
+#
+# Logging calls only put the record on a queue, a background thread writes it to the file and to
+# stderr, so the sync loop never waits on disk. The file is rotated by size so it doesn't grow
+# forever, and it is only ever read from the end: the last lines, or whatever was appended after a
+# known byte offset, never the whole file. Forked gunicorn workers log to stderr only.
+
+import atexit
+from collections.abc import Iterator
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import time
+
+import runtime
+
+LOG_PATH = "/tmp/logs.txt"
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# Level of each logger unless set in the `log_levels` config, "root" applies to everything else.
+# Payloads sent to Holded are logged at DEBUG by `holded`, they are only formatted when enabled
+DEFAULT_LEVELS = {"root": "WARNING", "bridge": "INFO", "holded": "WARNING", "repairdesk": "WARNING"}
+
+# Bytes read at first when looking for the last lines, doubled until enough lines are found
+TAIL_WINDOW = 64 * 1024
+# Most bytes read to serve one request, older lines are out of reach of a filtered tail
+MAX_READ = 8 * 1024 * 1024
+# Seconds between checks for new lines while following the file
+FOLLOW_INTERVAL = 0.5
+
+
+def handler() -> logging.Handler:
+    config = runtime.config()
+    h = RotatingFileHandler(
+        LOG_PATH,
+        maxBytes=config.get("log_max_bytes", 5 * 1024 * 1024),
+        backupCount=config.get("log_backups", 3),
+    )
+    h.setFormatter(logging.Formatter(FORMAT))
+    return h
+
+
+_listener: QueueListener | None = None
+
+
+def setup():
+    """Configures logging for the whole process: levels from the config, queued file and stderr"""
+    global _listener
+    if _listener is not None:
+        return
+
+    levels = DEFAULT_LEVELS | runtime.config().get("log_levels", {})
+    for name, level in levels.items():
+        logging.getLogger(None if name == "root" else name).setLevel(level)
+
+    stderr = logging.StreamHandler()
+    stderr.setFormatter(logging.Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    logging.getLogger().addHandler(QueueHandler(records))
+    _listener = QueueListener(records, handler(), stderr)
+    _listener.start()
+    # Flush what is left in the queue on exit
+    atexit.register(_stop)
+    # The writer thread doesn't survive a fork, gunicorn workers start their own (stderr only)
+    os.register_at_fork(after_in_child=_restart)
+
+
+def _stop():
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart():
+    global _listener
+    assert _listener is not None
+    records = queue.SimpleQueue()
+    for h in logging.getLogger().handlers:
+        if isinstance(h, QueueHandler):
+            h.queue = records
+    # Only the process that set up logging writes and rotates the file. A worker rotating it too
+    # would rename it away under the others, which keep writing to the old one
+    handlers = [h for h in _listener.handlers if not isinstance(h, RotatingFileHandler)]
+    _listener = QueueListener(records, *handlers)
+    _listener.start()
+
+
+def _filter(lines: list[str], level: str | None) -> list[str]:
+    """
+    Lines of records at `level` or above. Lines that don't start a record (tracebacks,
+    multi-line messages) belong to the record before them.
+    """
+    if level is None:
+        return lines
+    minimum = LEVELS.index(level)
+    keep = False
+    kept = []
+    for line in lines:
+        fields = line.split(" ", 3)
+        if len(fields) > 2 and fields[2] in LEVELS:
+            keep = LEVELS.index(fields[2]) >= minimum
+        if keep:
+            kept.append(line)
+    return kept
+
+
+def tail(lines: int, level: str | None = None) -> tuple[list[str], int]:
+    """
+    The last `lines` lines at `level` or above and the size of the file, to be passed as
+    `offset` to `read_from` to get what comes after them.
+    """
+    try:
+        f = open(LOG_PATH, "rb")
+    except FileNotFoundError:
+        return [], 0
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        window = TAIL_WINDOW
+        while True:
+            start = max(0, size - min(window, MAX_READ))
+            f.seek(start)
+            chunk = f.read(size - start).decode(errors="replace").split("\n")
+            if start > 0:
+                chunk = chunk[1:]  # Partial line
+            if chunk and chunk[-1] == "":
+                chunk.pop()
+            found = _filter(chunk, level)
+            if len(found) >= lines or start == 0 or window >= MAX_READ:
+                return found[-lines:] if lines > 0 else [], size
+            window *= 2
+
+
+def read_from(offset: int, level: str | None = None) -> tuple[list[str], int]:
+    """
+    Complete lines written from byte `offset` on (up to MAX_READ bytes) and the offset to continue
+    from. Starts over from the beginning when the file has been rotated or cleared since.
+    """
+    try:
+        f = open(LOG_PATH, "rb")
+    except FileNotFoundError:
+        return [], 0
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(size - offset, MAX_READ))
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode(errors="replace").split("\n")[:-1]
+    return _filter(lines, level), offset + end
+
+
+def follow(offset: int, level: str | None, duration: float) -> Iterator[tuple[list[str], int]]:
+    """
+    New lines as they are written, for `duration` seconds, with the offset after them. Yields an
+    empty list every FOLLOW_INTERVAL when there is nothing new, so callers can notice a
+    disconnected client.
+    """
+    inode = _inode()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        if (current := _inode()) != inode:
+            inode, offset = current, 0  # Rotated, the new file is read from its start
+        lines, offset = read_from(offset, level)
+        yield lines, offset
+        if not lines:
+            time.sleep(FOLLOW_INTERVAL)
+
+
+def _inode() -> int | None:
+    try:
+        return os.stat(LOG_PATH).st_ino
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,174 @@
+# Prometheus text exposition of the bridge's metrics
+#
+# API calls are made by the sync thread in the gunicorn master while /metrics is served by a
+# worker, so every process publishes a snapshot of its own metrics to the shared Manager dict (the
+# master every few seconds, workers as they serve requests) and /metrics merges all of them.
+# Snapshots of workers that have exited are kept, their counts still add to the totals. API metrics
+# are collected by the clients themselves, requests served by the web UI by `HttpMetrics`.
+
+from collections.abc import Callable
+import os
+import threading
+from threading import Lock
+from time import monotonic
+from typing import Any
+
+import runtime
+
+# Seconds between two snapshots published by the same process
+PUBLISH_INTERVAL = 5
+# Upper bounds in seconds of the web UI latency histogram buckets, the last one is +Inf
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_published = 0.0
+
+
+def publish(name: str, snapshot: dict[str, Any], force: bool = False):
+    """
+    Makes `snapshot` the current metrics of process `name`. Skipped when the last one was
+    published less than PUBLISH_INTERVAL seconds ago, unless `force`.
+    """
+    global _published
+    now = monotonic()
+    if not force and now - _published < PUBLISH_INTERVAL:
+        return
+    _published = now
+    runtime.shared().metrics[name] = snapshot
+
+
+def publish_forever(exit_event: threading.Event, name: str, snapshot: Callable[[], dict]):
+    while not exit_event.wait(timeout=PUBLISH_INTERVAL):
+        publish(name, snapshot(), force=True)
+
+
+class HttpMetrics:
+    """Requests served by the web UI by route, method and status, with a latency histogram"""
+
+    def __init__(self, buckets: tuple[float, ...] = HTTP_BUCKETS):
+        self.buckets = buckets
+        self._requests: dict[tuple[str, str, str], int] = {}
+        self._latency: dict[tuple[str, str], list[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, route: str, method: str, status: int, seconds: float):
+        key = (route, method)
+        with self._lock:
+            self._requests[(*key, str(status))] = self._requests.get((*key, str(status)), 0) + 1
+            # One count per bucket (the last one is +Inf), then the sum
+            hist = self._latency.setdefault(key, [0] * (len(self.buckets) + 2))
+            i = next((i for i, b in enumerate(self.buckets) if seconds <= b), len(self.buckets))
+            hist[i] += 1
+            hist[-1] += seconds
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "requests": dict(self._requests),
+                "latency": {k: list(v) for k, v in self._latency.items()},
+            }
+
+
+def process_name() -> str:
+    return "worker-{}".format(os.getpid())
+
+
+def _labels(**labels: str) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels.items()) + "}"
+
+
+def _merge(into: dict, snapshot: dict):
+    into.setdefault("buckets", snapshot["buckets"])
+    for kind in ("requests", "errors", "retries", "throttled"):
+        merged = into.setdefault(kind, {})
+        for key, value in snapshot.get(kind, {}).items():
+            merged[key] = merged.get(key, 0) + value
+    merged = into.setdefault("latency", {})
+    for key, hist in snapshot["latency"].items():
+        merged[key] = [a + b for a, b in zip(merged.get(key, [0] * len(hist)), hist)]
+
+
+def _histogram(name: str, labels: dict[str, str], buckets: list[float], hist: list[float]):
+    lines = []
+    count = 0
+    for bound, n in zip([*map(str, buckets), "+Inf"], hist):
+        count += int(n)
+        lines.append("{}_bucket{} {}".format(name, _labels(**labels, le=bound), count))
+    lines.append("{}_sum{} {}".format(name, _labels(**labels), hist[-1]))
+    lines.append("{}_count{} {}".format(name, _labels(**labels), count))
+    return lines
+
+
+def render() -> str:
+    """Every process' metrics merged, in Prometheus text format"""
+    apis: dict[str, dict] = {}
+    http: dict = {}
+    gauges: dict[str, dict[str, float]] = {}
+    for snapshot in runtime.shared().metrics.values():
+        for api, api_snapshot in snapshot.get("apis", {}).items():
+            _merge(apis.setdefault(api, {}), api_snapshot)
+        if "http" in snapshot:
+            _merge(http, snapshot["http"])
+        for gauge, values in snapshot.get("gauges", {}).items():
+            gauges.setdefault(gauge, {}).update(values)
+
+    out = []
+    for kind, name, help in [
+        ("requests", "bridge_api_requests_total", "Requests sent to the APIs by final status"),
+        ("errors", "bridge_api_errors_total", "Failed requests by status code or exception"),
+    ]:
+        out += ["# HELP {} {}".format(name, help), "# TYPE {} counter".format(name)]
+        for api, snapshot in apis.items():
+            for (endpoint, method, status), n in snapshot.get(kind, {}).items():
+                labels = _labels(api=api, endpoint=endpoint, method=method, status=status)
+                out.append("{}{} {}".format(name, labels, n))
+    for kind, name, help in [
+        ("retries", "bridge_api_retries_total", "Attempts repeated after a failure or a 429"),
+        ("throttled", "bridge_api_throttled_seconds_total", "Time waited on the rate limiter"),
+    ]:
+        out += ["# HELP {} {}".format(name, help), "# TYPE {} counter".format(name)]
+        for api, snapshot in apis.items():
+            for (endpoint, method), n in snapshot.get(kind, {}).items():
+                labels = _labels(api=api, endpoint=endpoint, method=method)
+                out.append("{}{} {}".format(name, labels, n))
+
+    name = "bridge_api_request_duration_seconds"
+    out += [
+        "# HELP {} Time from sending a request until its response arrived".format(name),
+        "# TYPE {} histogram".format(name),
+    ]
+    for api, snapshot in apis.items():
+        for (endpoint, method), hist in snapshot.get("latency", {}).items():
+            labels = {"api": api, "endpoint": endpoint, "method": method}
+            out += _histogram(name, labels, snapshot["buckets"], hist)
+
+    name = "bridge_api_circuit_open"
+    out += [
+        "# HELP {} Whether calls to the API are being refused by its circuit breaker".format(name),
+        "# TYPE {} gauge".format(name),
+    ]
+    for api, value in gauges.get("circuit_open", {}).items():
+        out.append("{}{} {}".format(name, _labels(api=api), value))
+
+    if http:
+        name = "bridge_http_requests_total"
+        out += [
+            "# HELP {} Requests served by the web UI".format(name),
+            "# TYPE {} counter".format(name),
+        ]
+        for (route, method, status), n in http["requests"].items():
+            out.append(
+                "{}{} {}".format(name, _labels(route=route, method=method, status=status), n)
+            )
+        name = "bridge_http_request_duration_seconds"
+        out += [
+            "# HELP {} Time taken to serve web UI requests".format(name),
+            "# TYPE {} histogram".format(name),
+        ]
+        for (route, method), hist in http["latency"].items():
+            out += _histogram(name, {"route": route, "method": method}, http["buckets"], hist)
+
+    return "\n".join(out) + "\n"
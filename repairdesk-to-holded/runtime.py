@@ -0,0 +1,67 @@
+# Process-wide state of the bridge, created on first use instead of at import
+#
+# The configuration is read once and shared by every module. The multiprocessing Manager holding
+# the state shared between the sync thread (gunicorn master) and the Flask workers is only started
+# when something needs it; gunicorn's `on_starting` hook does so before forking the workers so all
+# of them share the same one.
+
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cache
+import json
+import multiprocessing as mp
+from multiprocessing.managers import DictProxy, ListProxy, SyncManager
+from time import monotonic
+from typing import Any
+
+CONFIG_PATH = "/etc/repairdesk-to-holded.conf.json"
+
+# Measured from the first import of this module, which is the first thing the gunicorn config does
+STARTED = monotonic()
+
+
+@cache
+def config() -> dict[str, Any]:
+    with open(CONFIG_PATH) as f:
+        return json.load(f)
+
+
+def data_path(name: str) -> str:
+    return config()["data_dir"].rstrip("/") + "/" + name
+
+
+@dataclass(frozen=True)
+class Shared:
+    manager: SyncManager
+    # Sync status shown in /status
+    state: DictProxy
+    lock: Any
+    # Metrics snapshot of each process, see the metrics module
+    metrics: DictProxy
+    # Finished sync job runs, oldest first, see the history module
+    history: ListProxy
+
+
+@cache
+def shared() -> Shared:
+    manager = mp.Manager()
+    return Shared(
+        manager=manager,
+        state=manager.dict(
+            {
+                "last_run": 0,
+                "next_loop": datetime.now().timestamp(),
+                "state": "starting",
+                "breakers": {"repairdesk": "closed", "holded": "closed"},
+                "startup": None,
+                "queued": 0,
+            }
+        ),
+        lock=manager.Lock(),
+        metrics=manager.dict(),
+        history=manager.list(),
+    )
+
+
+def since_start() -> float:
+    return monotonic() - STARTED
@@ -1,91 +1,261 @@
-from flask import Flask, render_template, request, redirect
-from datetime import datetime
-import multiprocessing as mp
-from dataclasses import dataclass
-import json
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    jsonify,
+    render_template,
+    request,
+    redirect,
+    stream_with_context,
+)
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from time import monotonic
+import history
+import logfile
+import metrics
+import runtime
+import tracing
+import warnings_store
 
 
-@dataclass
-class Warning:
-    messages: list[str]
-    hd_invoice_id: str | None
-    rd_invoice_id: str | None
-    order_id: str
-    id: str | None = None
+app = Flask(__name__)
+CONFIG = runtime.config()
 
+# Requests served by this worker, published for /metrics
+http_metrics = metrics.HttpMetrics()
 
-app = Flask(__name__)
-CONFIG = json.load(open("/etc/repairdesk-to-holded.conf.json"))
+# Log lines shown unless `lines` is given, and the most that can be asked for
+LOG_LINES = 200
+MAX_LOG_LINES = 5000
+# Seconds a /logs/stream connection is kept open before the browser has to reconnect, so
+# followers don't hold a worker thread forever
+LOG_STREAM_DURATION = 300
+# Seconds without new lines after which a comment is sent to keep proxies from closing the stream
+LOG_STREAM_KEEPALIVE = 15
 
-manager = mp.Manager()
-shared_dict = manager.dict(
-    {"last_run": 0, "next_loop": datetime.now().timestamp(), "state": "running"}
-)
-shared_lock = manager.Lock()
+# Warnings shown per page unless `per_page` is given, and the most that can be asked for
+WARNINGS_PER_PAGE = 50
+MAX_WARNINGS_PER_PAGE = 500
+
+# Runs listed in /traces
+TRACE_RUNS = 20
+
+# Job runs shown in /status, /api/history returns up to history.HISTORY_SIZE
+STATUS_JOB_RUNS = 10
+
+
+@app.before_request
+def start_timer():
+    g.start = monotonic()
 
-warnings_lock = manager.Lock()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    http_metrics.observe(route, request.method, response.status_code, monotonic() - g.start)
+    metrics.publish(metrics.process_name(), {"http": http_metrics.snapshot()})
+    return response
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    metrics.publish(metrics.process_name(), {"http": http_metrics.snapshot()}, force=True)
+    return metrics.render(), {"Content-Type": "text/plain; version=0.0.4"}
 
 
 @app.route("/")
 def index():
-    return render_template("index.html")
+    return render_template("index.html", message_kinds=warnings_store.MESSAGE_KINDS)
 
 
 @app.route("/status")
 def status():
-    with shared_lock:
-        if shared_dict["state"] == "running":
-            next_loop = "unknown (still running)"
+    shared = runtime.shared()
+    with shared.lock:
+        if shared.state["state"] in ("running", "starting"):
+            next_loop = "unknown (still {})".format(shared.state["state"])
         else:
-            next_loop = datetime.fromtimestamp(shared_dict["next_loop"]) - datetime.now()
+            next_loop = datetime.fromtimestamp(shared.state["next_loop"]) - datetime.now()
         return render_template(
             "status.html",
-            status=shared_dict["state"],
-            last_run=shared_dict["last_run"],
+            status=shared.state["state"],
+            last_run=shared.state["last_run"],
             next_loop=next_loop,
+            breakers=shared.state["breakers"],
+            startup=shared.state["startup"],
+            queued=shared.state["queued"],
+            job_runs=history.last(STATUS_JOB_RUNS),
         )
 
 
+@app.route("/api/history")
+def api_history():
+    """Last job runs, newest first. `job` keeps only the runs of one job, `limit` caps how many"""
+    limit = min(history.HISTORY_SIZE, max(0, request.args.get("limit", 100, type=int)))
+    job = request.args.get("job")
+    runs = history.last() if job else history.last(limit)
+    if job:
+        runs = [r for r in runs if r["job"] == job][:limit]
+    return jsonify({"runs": runs})
+
+
+def _log_level() -> str | None:
+    level = request.args.get("level") or None
+    if level is not None and level not in logfile.LEVELS:
+        abort(400, "level must be one of {}".format(", ".join(logfile.LEVELS)))
+    return level
+
+
 @app.route("/logs")
 def logs():
-    return render_template("logs.html", logs=open("/tmp/logs.txt").read().split("\n"))
+    """
+    The last `lines` log lines at `level` or above, or those written after byte `offset`.
+    The offset to continue from is returned in the X-Log-Offset header.
+    """
+    level = _log_level()
+    if "offset" in request.args:
+        lines, offset = logfile.read_from(request.args.get("offset", 0, type=int), level)
+    else:
+        count = min(MAX_LOG_LINES, max(0, request.args.get("lines", LOG_LINES, type=int)))
+        lines, offset = logfile.tail(count, level)
+    return render_template("logs.html", logs=lines), {"X-Log-Offset": str(offset)}
+
+
+@app.route("/logs/stream")
+def stream_logs():
+    """
+    Server-sent events with the log lines at `level` or above as they are written. Each event
+    carries its end offset as id, so the browser resumes where it left off when it reconnects.
+    """
+    level = _log_level()
+    resume = request.headers.get("Last-Event-ID", type=int)
+    offset = resume if resume is not None else logfile.tail(0)[1]
+
+    def events():
+        yield "retry: 1000\n\n"
+        idle = 0.0
+        for lines, end in logfile.follow(offset, level, LOG_STREAM_DURATION):
+            if lines:
+                idle = 0.0
+                data = "".join("data: " + line + "\n" for line in lines)
+                yield "id: {}\n{}\n".format(end, data)
+            else:
+                idle += logfile.FOLLOW_INTERVAL
+                if idle >= LOG_STREAM_KEEPALIVE:
+                    idle = 0.0
+                    yield "id: {}\n: keep-alive\n\n".format(end)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/logs/clear")
 def clear_logs():
-    open("/tmp/logs.txt", "w").close()  # Clear file
+    open(logfile.LOG_PATH, "w").close()  # Clear file
     return ("", 204)
 
 
+@app.route("/traces")
+def traces():
+    """
+    Where the time of a sync run went: per stage totals and the slowest invoices. Shows the run
+    given as `run`, otherwise the last one that synced any invoice.
+    """
+    runs = tracing.last_runs(TRACE_RUNS)
+    wanted = request.args.get("run")
+    run = next((r for r in runs if (r["run"] == wanted if wanted else r["invoices"] > 0)), None)
+    stages = []
+    if run is not None:
+        total = sum(run["stages"].values())
+        stages = [
+            {
+                "stage": stage,
+                "total": seconds,
+                "avg": seconds / run["invoices"] if run["invoices"] else 0.0,
+                "share": seconds / total if total else 0.0,
+            }
+            for stage, seconds in sorted(run["stages"].items(), key=lambda s: s[1], reverse=True)
+        ]
+    return render_template("traces.html", run=run, stages=stages, runs=runs)
+
+
+def _warnings_page() -> tuple[warnings_store.Page, str | None, str | None]:
+    """
+    Reads the page of warnings requested in the query string: `kind` (of a message, see
+    warnings_store.MESSAGE_KINDS), `order_id`, `from`/`to` (dates, both included), `sort` (newest,
+    oldest, order_id), `after` or `before` (cursors of the page to read) and `per_page`. Returns
+    the page and the cursors it was read with.
+    """
+    try:
+        since = datetime.fromisoformat(request.args["from"]) if request.args.get("from") else None
+        until = (
+            datetime.fromisoformat(request.args["to"]) + timedelta(days=1)
+            if request.args.get("to")
+            else None
+        )
+    except ValueError:
+        abort(400, "dates must be in YYYY-MM-DD format")
+    sort = request.args.get("sort", "newest")
+    if sort not in warnings_store.SORTS:
+        abort(400, "sort must be one of {}".format(", ".join(warnings_store.SORTS)))
+    kind = request.args.get("kind") or None
+    if kind is not None and kind != "other" and kind not in warnings_store.MESSAGE_KINDS:
+        abort(400, "kind must be one of {}, other".format(", ".join(warnings_store.MESSAGE_KINDS)))
+    after = request.args.get("after") or None
+    before = request.args.get("before") or None
+    per_page = min(
+        MAX_WARNINGS_PER_PAGE, max(1, request.args.get("per_page", WARNINGS_PER_PAGE, type=int))
+    )
+
+    try:
+        page = warnings_store.store().query(
+            kind=kind,
+            order_id=request.args.get("order_id") or None,
+            since=since,
+            until=until,
+            sort=sort,
+            limit=per_page,
+            after=after,
+            before=before,
+        )
+    except ValueError:
+        abort(400, "invalid page cursor")
+    return page, after, before
+
+
 @app.route("/warnings")
 def warnings():
-    with warnings_lock:
-        try:
-            return render_template(
-                "warnings.html",
-                warnings=map(
-                    lambda w: Warning(
-                        id=w["id"],
-                        messages=w["messages"],
-                        rd_invoice_id=w["rd_invoice_id"],
-                        hd_invoice_id=w["hd_invoice_id"],
-                        order_id=w["order_id"],
-                    ),
-                    json.load(open(CONFIG["data_dir"].rstrip("/") + "/warnings.json")),
-                ),
-                business_name=CONFIG["business_name"],
-            )
-        except FileNotFoundError:
-            return ""
+    page, after, before = _warnings_page()
+    return render_template(
+        "warnings.html",
+        page=page,
+        after=after,
+        before=before,
+        business_name=CONFIG["business_name"],
+    )
+
+
+@app.route("/api/warnings")
+def api_warnings():
+    page, _, _ = _warnings_page()
+    return jsonify(
+        {
+            "warnings": [
+                asdict(w) | {"created": w.created.isoformat() if w.created else None}
+                for w in page.warnings
+            ],
+            "prev": page.prev,
+            "next": page.next,
+        }
+    )
 
 
 @app.route("/warnings/discard")
 def discard_warning():
-    with warnings_lock:
-        # Remove the warning with given id
-        warns_removed = filter(
-            lambda w: w["id"] != request.args.get("id", ""),
-            json.load(open(CONFIG["data_dir"].rstrip("/") + "/warnings.json")),
-        )
-        json.dump(list(warns_removed), open(CONFIG["data_dir"].rstrip("/") + "/warnings.json", "w"))
+    warnings_store.store().discard(request.args.get("id", ""))
     return redirect("/")
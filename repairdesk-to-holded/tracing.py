@@ -0,0 +1,180 @@
+# Lightweight tracing of the sync pipeline, written as JSON lines under `data_dir`
+#
+# A sync job run is a run, each invoice synced for it is a trace and each stage of an invoice
+# (sanity checks, contact, Holded lookup, writes, payments, email) is a span. Spans are buffered
+# and written once per invoice to `traces.jsonl`; when the run ends a summary with the time spent
+# per stage and the slowest invoices goes to `runs.jsonl`, which is all /traces has to read.
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+import json
+import os
+import threading
+from time import monotonic
+from uuid import uuid4
+
+import runtime
+
+# Invoices listed in each run summary
+SLOWEST_INVOICES = 20
+# Size at which traces.jsonl and runs.jsonl are rotated, keeping a single older file each
+MAX_FILE_SIZE = 20 * 1024 * 1024
+# Bytes read from the end of runs.jsonl to list the last runs
+RUNS_TAIL = 1024 * 1024
+
+
+@dataclass
+class Run:
+    id: str
+    job: str
+    started: datetime
+    start: float
+    stages: dict[str, float] = field(default_factory=dict)
+    invoices: list[dict] = field(default_factory=list)
+    spans: list[dict] = field(default_factory=list)
+    # Stages of the sync pipeline run on the event loop and in threads at the same time
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+
+@dataclass
+class _Invoice:
+    order_id: str
+    start: float
+    stages: dict[str, float] = field(default_factory=dict)
+
+
+_run: ContextVar[Run | None] = ContextVar("run", default=None)
+_invoice: ContextVar[_Invoice | None] = ContextVar("invoice", default=None)
+
+
+def _append(name: str, records: list[dict]):
+    if not records:
+        return
+    path = runtime.data_path(name)
+    try:
+        if os.path.getsize(path) > MAX_FILE_SIZE:
+            os.replace(path, path + ".1")
+    except FileNotFoundError:
+        pass
+    with open(path, "a") as f:
+        f.write("".join(json.dumps(r) + "\n" for r in records))
+
+
+def start(job: str) -> Run:
+    """
+    A new run of `job`. Its invoices may be synced a few at a time, interleaved with those of
+    other runs, each time inside `resume`; it is written out by `finish`.
+    """
+    return Run(id=uuid4().hex, job=job, started=datetime.now(), start=monotonic())
+
+
+@contextmanager
+def resume(run: Run) -> Iterator[None]:
+    """Traces what is done inside as part of `run`"""
+    token = _run.set(run)
+    try:
+        yield
+    finally:
+        _run.reset(token)
+
+
+def finish(run: Run):
+    with run.lock:
+        spans, run.spans = run.spans, []
+        slowest = sorted(run.invoices, key=lambda i: i["duration"], reverse=True)
+        stages = dict(run.stages)
+    _append("traces.jsonl", spans)
+    _append(
+        "runs.jsonl",
+        [
+            {
+                "run": run.id,
+                "job": run.job,
+                "start": run.started.isoformat(),
+                "duration": monotonic() - run.start,
+                "invoices": len(run.invoices),
+                "stages": stages,
+                "slowest": slowest[:SLOWEST_INVOICES],
+            }
+        ],
+    )
+
+
+@contextmanager
+def invoice(order_id: str) -> Iterator[None]:
+    """Traces the stages of syncing one invoice, its spans are written when it ends"""
+    current = _run.get()
+    if current is None:
+        yield
+        return
+    trace = _Invoice(order_id=order_id, start=monotonic())
+    token = _invoice.set(trace)
+    try:
+        yield
+    finally:
+        _invoice.reset(token)
+        with current.lock:
+            current.invoices.append(
+                {
+                    "order_id": order_id,
+                    "duration": monotonic() - trace.start,
+                    "stages": trace.stages,
+                }
+            )
+            # Swapped, spans of other invoices of the run may be added meanwhile
+            spans, current.spans = current.spans, []
+        _append("traces.jsonl", spans)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times `stage` of the current invoice, or of the run itself outside of any invoice"""
+    current = _run.get()
+    if current is None:
+        yield
+        return
+    started = datetime.now()
+    start = monotonic()
+    try:
+        yield
+    finally:
+        duration = monotonic() - start
+        trace = _invoice.get()
+        with current.lock:
+            current.stages[stage] = current.stages.get(stage, 0.0) + duration
+            if trace is not None:
+                trace.stages[stage] = trace.stages.get(stage, 0.0) + duration
+            current.spans.append(
+                {
+                    "run": current.id,
+                    "job": current.job,
+                    "order_id": trace.order_id if trace is not None else None,
+                    "stage": stage,
+                    "start": started.isoformat(),
+                    "duration": duration,
+                }
+            )
+
+
+def last_runs(limit: int) -> list[dict]:
+    """Summaries of the last `limit` runs, newest first"""
+    try:
+        f = open(runtime.data_path("runs.jsonl"), "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(max(0, size - RUNS_TAIL))
+        lines = f.read().decode(errors="replace").split("\n")
+    if size > RUNS_TAIL:
+        lines = lines[1:]  # Partial line
+    runs = []
+    for line in reversed(lines):
+        if len(runs) == limit:
+            break
+        if line:
+            runs.append(json.loads(line))
+    return runs
@@ -0,0 +1,364 @@
+# Warnings shown in the web UI, stored in SQLite under `data_dir`
+#
+# Written by the sync thread and read/discarded by the Flask workers. Each process opens its own
+# connection and SQLite serializes the writers, so no lock has to be shared between processes.
+# Warnings are indexed by the RepairDesk and Holded invoice ids they refer to, which is how new
+# messages are merged into an existing warning. The old `warnings.json` is imported once.
+#
+# Pages are read by key (after/before the last warning shown) and messages are filtered by kind
+# through an indexed table, so reading any page costs the same however many warnings are stored.
+
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cache
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Any
+from uuid import uuid4
+
+import runtime
+
+logger = logging.getLogger(__name__)
+
+# Columns and direction of each sort accepted by `WarningStore.query`, seq is unique and ends each
+# of them. All columns go in the same direction so a page is a range of an index
+SORTS = {
+    "newest": (["seq"], "DESC"),
+    "oldest": (["seq"], "ASC"),
+    "order_id": (["order_id", "seq"], "ASC"),
+}
+
+# Kind of each message the bridge writes, by the start of its text. Messages starting with none
+# of them are of kind "other"
+MESSAGE_KINDS = {
+    "sum_mismatch": "failed sanity check: sum(items) != total",
+    "rebu_mixed": "failed sanity check: REBU invoice contains",
+    "walkin": "failed sanity check: walkin customer",
+    "contact": "failed: could not sync or find Holded contact",
+    "rd_payments_missing": "RD says PAID but RD payments miss",
+    "approved_mismatch": "approved document is mismatched",
+    "hd_payments_missing": "missing payments in RepairDesk",
+    "payment_mismatch": "mismatched payment amount",
+    "rebu_draft": "REBU invoice (created as draft)",
+    "old_ticket": "associated ticket > 30 days",
+    "api_error": "Holded API error",
+}
+
+# Bumped when the schema changes, older databases are upgraded when opened
+SCHEMA_VERSION = 1
+
+
+def message_kind(message: str) -> str:
+    return next((k for k, prefix in MESSAGE_KINDS.items() if message.startswith(prefix)), "other")
+
+
+@dataclass
+class Warning:
+    messages: list[str]
+    hd_invoice_id: str | None
+    rd_invoice_id: str | None
+    order_id: str
+    id: str | None = None
+    created: datetime | None = None
+    seq: int | None = None
+
+
+@dataclass
+class Page:
+    warnings: list[Warning]
+    # To be passed as `before`/`after` to `WarningStore.query` for the previous and next pages,
+    # None when there are none
+    prev: str | None
+    next: str | None
+
+
+class WarningStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        # Connections can't cross a fork, gunicorn workers open their own
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            self._pid = os.getpid()
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS warnings ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE,"
+                " order_id TEXT NOT NULL, rd_invoice_id TEXT, hd_invoice_id TEXT,"
+                " messages TEXT NOT NULL, created TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS warnings_rd ON warnings (rd_invoice_id, hd_invoice_id)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS warnings_hd ON warnings (hd_invoice_id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS warnings_order ON warnings (order_id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS warnings_created ON warnings (created)")
+            # Kinds of the messages of each warning, to filter by kind without reading messages.
+            # Holds the sort columns too, a filtered page is read from here in order
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS warning_kinds ("
+                " kind TEXT NOT NULL, seq INTEGER NOT NULL, order_id TEXT NOT NULL,"
+                " PRIMARY KEY (kind, seq)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS warning_kinds_seq ON warning_kinds (seq)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS warning_kinds_order"
+                " ON warning_kinds (kind, order_id, seq)"
+            )
+            if self._db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._index_kinds(self._db)
+            self._migrate_json(self._db)
+        return self._db
+
+    @staticmethod
+    def _add_kinds(db: sqlite3.Connection, seq: int, order_id: str, messages: list[str]):
+        db.executemany(
+            "INSERT OR IGNORE INTO warning_kinds (kind, seq, order_id) VALUES (?, ?, ?)",
+            [(message_kind(m), seq, order_id) for m in messages],
+        )
+
+    def _index_kinds(self, db: sqlite3.Connection):
+        """Indexes the kinds of every stored warning, written before they were indexed"""
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute("SELECT seq, order_id, messages FROM warnings").fetchall()
+            for seq, order_id, messages in rows:
+                self._add_kinds(db, seq, order_id, json.loads(messages))
+            db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _migrate_json(self, db: sqlite3.Connection):
+        legacy = os.path.join(os.path.dirname(self.path), "warnings.json")
+        try:
+            with open(legacy) as f:
+                warns = json.load(f)
+        except FileNotFoundError:
+            return
+        now = datetime.now().isoformat()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for w in warns:
+                db.execute(
+                    "INSERT OR IGNORE INTO warnings"
+                    " (id, order_id, rd_invoice_id, hd_invoice_id, messages, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        w["id"],
+                        w["order_id"],
+                        w["rd_invoice_id"],
+                        w["hd_invoice_id"],
+                        json.dumps(w["messages"], ensure_ascii=False),
+                        now,
+                    ),
+                )
+                (seq,) = db.execute("SELECT seq FROM warnings WHERE id = ?", (w["id"],)).fetchone()
+                self._add_kinds(db, seq, w["order_id"], w["messages"])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        try:
+            os.replace(legacy, legacy + ".migrated")
+        except FileNotFoundError:
+            return  # Another process migrated it at the same time
+        logger.info("Migrated %s warnings from %s", len(warns), legacy)
+
+    @staticmethod
+    def _into_warning(row) -> Warning:
+        return Warning(
+            id=row[0],
+            order_id=row[1],
+            rd_invoice_id=row[2],
+            hd_invoice_id=row[3],
+            messages=json.loads(row[4]),
+            created=datetime.fromisoformat(row[5]),
+            seq=row[6],
+        )
+
+    def append(
+        self, message: str, order_id: str, hd_invoice_id: str | None, rd_invoice_id: str | None
+    ):
+        """Adds `message` to the warning of the same invoice, creating it if there is none"""
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if hd_invoice_id is not None and rd_invoice_id is not None:
+                    row = db.execute(
+                        "SELECT seq, order_id, messages FROM warnings"
+                        " WHERE rd_invoice_id = ? AND hd_invoice_id = ?",
+                        (rd_invoice_id, hd_invoice_id),
+                    ).fetchone()
+                elif hd_invoice_id is not None:
+                    row = db.execute(
+                        "SELECT seq, order_id, messages FROM warnings WHERE hd_invoice_id = ?",
+                        (hd_invoice_id,),
+                    ).fetchone()
+                elif rd_invoice_id is not None:
+                    row = db.execute(
+                        "SELECT seq, order_id, messages FROM warnings WHERE rd_invoice_id = ?",
+                        (rd_invoice_id,),
+                    ).fetchone()
+                else:
+                    row = None
+
+                if row is not None:
+                    messages = json.loads(row[2])
+                    if message not in messages:
+                        messages.append(message)
+                        db.execute(
+                            "UPDATE warnings SET messages = ? WHERE seq = ?",
+                            (json.dumps(messages, ensure_ascii=False), row[0]),
+                        )
+                        self._add_kinds(db, row[0], row[1], [message])
+                else:
+                    inserted = db.execute(
+                        "INSERT INTO warnings"
+                        " (id, order_id, rd_invoice_id, hd_invoice_id, messages, created)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            str(uuid4()),
+                            order_id,
+                            rd_invoice_id,
+                            hd_invoice_id,
+                            json.dumps([message], ensure_ascii=False),
+                            datetime.now().isoformat(),
+                        ),
+                    )
+                    self._add_kinds(db, inserted.lastrowid, order_id, [message])
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def discard(self, id: str):
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    "DELETE FROM warning_kinds"
+                    " WHERE seq IN (SELECT seq FROM warnings WHERE id = ?)",
+                    (id,),
+                )
+                db.execute("DELETE FROM warnings WHERE id = ?", (id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def cursor(warning: Warning, sort: str) -> str:
+        """Position of `warning` in `sort`, to read the warnings after or before it"""
+        if sort == "order_id":
+            return "{}:{}".format(warning.seq, warning.order_id)
+        return str(warning.seq)
+
+    @staticmethod
+    def _values(cursor: str) -> dict[str, Any]:
+        """Sort columns of the warning at `cursor`, raises ValueError if it is malformed"""
+        seq, _, order_id = cursor.partition(":")
+        return {"seq": int(seq), "order_id": order_id}
+
+    def query(
+        self,
+        kind: str | None = None,
+        order_id: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        sort: str = "newest",
+        limit: int = 50,
+        after: str | None = None,
+        before: str | None = None,
+    ) -> Page:
+        """
+        Up to `limit` warnings with a message of `kind` (see MESSAGE_KINDS), for `order_id`,
+        created between `since` and `until`, sorted as named in SORTS and starting after the
+        `after` cursor (or ending before the `before` one). Only the requested page is read.
+        Raises ValueError if a cursor is malformed.
+        """
+        sql = (
+            "SELECT w.id, w.order_id, w.rd_invoice_id, w.hd_invoice_id, w.messages, w.created,"
+            " w.seq FROM warnings w"
+        )
+        where = []
+        params: list = []
+        # Filtered by kind, pages are read in order from the kinds table and joined
+        table = "w"
+        if kind:
+            sql += " JOIN warning_kinds k ON k.seq = w.seq"
+            where.append("k.kind = ?")
+            params.append(kind)
+            table = "k"
+        if order_id:
+            where.append("w.order_id = ?")
+            params.append(order_id)
+        if since is not None:
+            where.append("w.created >= ?")
+            params.append(since.isoformat())
+        if until is not None:
+            where.append("w.created < ?")
+            params.append(until.isoformat())
+
+        columns, direction = SORTS[sort]
+        keys = "(" + ", ".join("{}.{}".format(table, c) for c in columns) + ")"
+
+        def page(cursor: str | None, forward: bool, n: int) -> list:
+            ascending = (direction == "ASC") == forward
+            conditions = list(where)
+            page_params = list(params)
+            if cursor is not None:
+                values = self._values(cursor)
+                conditions.append(
+                    "{} {} ({})".format(
+                        keys, ">" if ascending else "<", ", ".join("?" * len(columns))
+                    )
+                )
+                page_params += [values[c] for c in columns]
+            query = sql
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            query += " ORDER BY {} LIMIT ?".format(
+                ", ".join(
+                    "{}.{} {}".format(table, c, "ASC" if ascending else "DESC") for c in columns
+                )
+            )
+            return self._conn().execute(query, (*page_params, n)).fetchall()
+
+        # One more than asked for to know whether there are more, without counting them all
+        with self._lock:
+            if before is not None:
+                rows = page(before, False, limit + 1)
+                has_prev = len(rows) > limit
+                warns = list(map(self._into_warning, rows[:limit][::-1]))
+                # The warning at `before` (or the ones after it) may have been discarded since
+                has_next = bool(warns) and bool(page(self.cursor(warns[-1], sort), True, 1))
+            else:
+                rows = page(after, True, limit + 1)
+                has_next = len(rows) > limit
+                warns = list(map(self._into_warning, rows[:limit]))
+                has_prev = after is not None and bool(
+                    page(self.cursor(warns[0], sort) if warns else after, False, 1)
+                )
+        return Page(
+            warnings=warns,
+            prev=(self.cursor(warns[0], sort) if warns else after) if has_prev else None,
+            next=self.cursor(warns[-1], sort) if has_next else None,
+        )
+
+
+@cache
+def store() -> WarningStore:
+    return WarningStore(runtime.data_path("warnings.sqlite3"))
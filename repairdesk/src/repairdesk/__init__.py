@@ -1,19 +1,30 @@
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
 from functools import cache
-from typing import Any
+from typing import Any, Iterator
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep
 from decimal import Decimal
 import logging
 
+from .cache import MemoryBackend as MemoryBackend, SQLiteBackend as SQLiteBackend, TicketCache
+from .metrics import Metrics
+from .ratelimit import RateLimiter, retry_after
+from .retry import CircuitBreaker, CircuitOpen as CircuitOpen, RemoteUnavailable, RetryPolicy
+from .stream import iter_json_array
+
 # Docs: https://api-docs.repairdesk.co
 
 logger = logging.getLogger(__name__)
 
 BASE_URL = "https://api.repairdesk.co/api/web/v1"
 
+# Bytes read at a time from streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 @dataclass
 class TicketStatus:
@@ -116,7 +127,10 @@ class Ticket:
 class Invoice:
     id: int
     order_id: str
+    # None when the invoice doesn't come from a ticket, or was fetched without `include_ticket`
     ticket: Ticket | None
+    # Set whenever the invoice comes from a ticket, to fetch it later with `ticket_by_id`
+    ticket_id: str | None
     date: datetime
     subtotal: Decimal
     total_tax: Decimal
@@ -141,56 +155,146 @@ class ApiError(Exception):
 @dataclass(frozen=True)
 class RepairDesk:
     api_key: str
+    # Maximum number of keep-alive connections kept open against the API, callers using the
+    # client from more threads than this will wait for a free connection
+    pool_size: int = 10
+    # Seconds, a stalled socket raises instead of blocking the caller forever
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    # Paces requests and honors 429/Retry-After, share it between clients using the same key
+    rate_limiter: RateLimiter = field(default_factory=RateLimiter, repr=False, compare=False)
+    retry_policy: RetryPolicy = field(default_factory=RetryPolicy, repr=False, compare=False)
+    circuit_breaker: CircuitBreaker = field(
+        default_factory=CircuitBreaker, repr=False, compare=False
+    )
+    metrics: Metrics = field(default_factory=Metrics, repr=False, compare=False)
+    # Avoids fetching the ticket again for every invoice coming from it, None disables caching
+    ticket_cache: TicketCache | None = field(default=None, repr=False, compare=False)
+    # Requests in flight at once in `invoice_by_ids`/`tickets_by_ids`, keep it at or below
+    # `pool_size`
+    batch_concurrency: int = 8
+    _session: requests.Session = field(init=False, repr=False, compare=False)
+    _executor: ThreadPoolExecutor = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        # Frozen dataclass, the session is created once and shared by every endpoint
+        object.__setattr__(self, "_session", session)
+        # Threads are only started once a batch method is used
+        object.__setattr__(
+            self,
+            "_executor",
+            ThreadPoolExecutor(max_workers=self.batch_concurrency, thread_name_prefix="repairdesk"),
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _request(
+        self, endpoint: str, params: dict[str, Any], stream: bool = False
+    ) -> tuple[requests.Response, Any]:
+        """
+        Sends the request honoring the rate limiter, retry policy and circuit breaker. Returns
+        the response and its decoded body, or None as body when `stream` is set (the caller
+        decodes it and must close the response).
+        """
+        attempts = self.retry_policy.attempts
+        error = None
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.metrics.retry(endpoint, "GET")
+            self.circuit_breaker.check()
+            start = monotonic()
+            self.rate_limiter.acquire("GET")
+            sent = monotonic()
+            self.metrics.throttled(endpoint, "GET", sent - start)
+            status: int | str | None = None
+            try:
+                resp = self._session.get(
+                    BASE_URL + endpoint,
+                    params=(params | {"api_key": self.api_key}),
+                    timeout=(self.connect_timeout, self.read_timeout),
+                    stream=stream,
+                )
+                status = resp.status_code
+                if resp.status_code >= 500:
+                    resp.close()
+                    resp.raise_for_status()
+                ret = resp.json() if resp.status_code != 429 and not stream else None
+            except Exception as e:
+                # Time until the headers arrived when streaming
+                self.metrics.observe(
+                    endpoint, "GET", status or type(e).__name__, monotonic() - sent
+                )
+                self.circuit_breaker.record_failure()
+                error = e
+                if attempt + 1 < attempts:
+                    delay = self.retry_policy.delay(attempt)
+                    logger.warning(
+                        "Request to %s failed (%s/%s), retrying in %.1fs: %s",
+                        endpoint,
+                        attempt + 1,
+                        attempts,
+                        delay,
+                        e,
+                    )
+                    sleep(delay)
+                continue
+            self.metrics.observe(endpoint, "GET", resp.status_code, monotonic() - sent)
+            self.circuit_breaker.record_success()
+
+            if resp.status_code == 429:
+                resp.close()
+                delay = retry_after(resp)
+                logger.warning("Rate limited on %s, waiting %.1fs", endpoint, delay)
+                self.rate_limiter.pause("GET", delay)
+                error = ApiError(429, "rate limited")
+                continue
+
+            return resp, ret
+
+        raise RemoteUnavailable("{} failed after {} attempts".format(endpoint, attempts)) from error
 
     def _call(self, endpoint: str, params: dict[str, Any]) -> dict:
-        try:
-            ret = requests.get(
-                BASE_URL + endpoint, params=(params | {"api_key": self.api_key})
-            ).json()
-        except Exception as e:
-            logger.warning("Request failed, retrying: {}".format(e))
-            sleep(10)
-            return self._call(endpoint, params)
-
-        if (
-            not ret["success"]
-            and ret["statusCode"] != 100  # Status code 100 is returned on empty invoice list
-        ):
-            raise ApiError(ret["statusCode"], ret["message"])
-        return ret["data"]
+        _, ret = self._request(endpoint, params)
+        return _unwrap(ret)
+
+    def _list(
+        self, endpoint: str, params: dict[str, Any], key: str, stream: bool = False
+    ) -> Iterator[dict]:
+        """
+        Yields the raw entries of a list endpoint. With `stream` the entries are decoded off
+        the response as it downloads instead of decoding the whole body first.
+        """
+        if not stream:
+            res = self._call(endpoint, params)
+            # When nothing is found a empty list is returned
+            yield from (res[key] if type(res) is not list else [])
+            return
+
+        resp, _ = self._request(endpoint, params, stream=True)
+        with resp:
+            body = yield from iter_json_array(resp.iter_content(STREAM_CHUNK_SIZE), key)
+        # The list was not in the response, it was decoded whole (e.g. an error or no results)
+        if body is not None:
+            res = _unwrap(body)
+            yield from ((res.get(key) or []) if type(res) is dict else [])
 
     def ticket_statuses(self) -> list[TicketStatus]:
-        ret = self._call("/statuses", {})
-        return list(
-            map(lambda s: TicketStatus(name=s["name"], color=s["color"], type=s["type"]), ret)
-        )
+        return _into_ticket_statuses(self._call("/statuses", {}))
 
     # Searches an item by either name or SKU
     def search_item(self, query: str) -> Item:
-        res = self._call("/inventory", {"keyword": query})
-        items = res["inventoryListData"]
-
-        match = None
-        for item in items:
-            if item["sku"] == query or item["name"] == query:
-                match = item
-                break
-
-        if match is None:
-            raise ItemNotFound
-        else:
-            return Item(
-                id=match["id"],
-                name=match["name"],
-                sku=match["sku"],
-                notes=None,
-                quantity=None,
-                price=None,
-                tax=None,
-                total=None,
-                tax_percent=None,
-                tax_class=None,
-            )
+        return _into_item_match(self._call("/inventory", {"keyword": query}), query)
 
     def invoices(
         self,
@@ -200,130 +304,306 @@ class RepairDesk:
         keyword: str | None = None,
         page_size: int = 50,
     ) -> list[BasicInvoice]:
-        res = self._call(
-            "/invoices",
-            {
-                "from_date": int(from_date.timestamp()) if from_date is not None else None,
-                "to_date": int(to_date.timestamp()) if to_date is not None else None,
-                "status": status.value if status is not None else None,
-                "keyword": keyword,
-                "pagesize": page_size,
-            },
-        )
-
-        # When no invoices are found a empty list is returned
-        if type(res) is list:
-            return []
-
-        invoices = []
-        for invoice in res["invoiceData"]:
-            invoices.append(
-                BasicInvoice(
-                    id=invoice["summary"]["id"],
-                    order_id=invoice["summary"]["order_id"],
-                    date=datetime.fromtimestamp(invoice["summary"]["created_date"]),
-                    # Sometimes RepairDesk returns no status for some reason
-                    status=InvoiceStatus(invoice["summary"]["status"])
-                    if "status" in invoice["summary"].keys()
-                    else None,
-                    customer=BasicCustomer(
-                        id=invoice["summary"]["customer"]["id"],
-                        name=invoice["summary"]["customer"]["fullName"],
-                    ),
-                )
+        return _into_basic_invoices(
+            self._call(
+                "/invoices", _invoices_params(from_date, to_date, status, keyword, page_size)
             )
-        return invoices
+        )
 
-    def ticket_by_id(self, id: str) -> Ticket:
+    def iter_invoices(
+        self,
+        from_date: datetime | None = None,
+        to_date: datetime | None = None,
+        status: InvoiceStatus | None = None,
+        keyword: str | None = None,
+        page_size: int = 100,
+        stream: bool = False,
+    ) -> Iterator[BasicInvoice]:
+        """
+        Walks the invoice listing page by page (newest first, like `invoices`), yielding each
+        invoice as soon as its page arrives. Unlike `invoices` the result is not capped at a
+        single page. With `stream` each page is decoded incrementally, one invoice at a time,
+        which keeps memory flat for large page sizes.
+        """
+        # Invoices created while paginating shift the listing, so a page can repeat entries of
+        # the previous one
+        seen = set()
+        page = 1
+        while True:
+            params = _invoices_params(from_date, to_date, status, keyword, page_size)
+            count = 0
+            new = 0
+            for raw in self._list("/invoices", params | {"page": page}, "invoiceData", stream):
+                count += 1
+                invoice = _into_basic_invoice(raw)
+                if invoice.id in seen:
+                    continue
+                seen.add(invoice.id)
+                new += 1
+                yield invoice
+
+            # A page with nothing new also means the API is ignoring `page`
+            if count < page_size or new == 0:
+                return
+            page += 1
+
+    def _ticket_data(self, id: str) -> dict:
+        if self.ticket_cache is not None:
+            cached = self.ticket_cache.get(id)
+            if cached is not None:
+                return cached
         ticket = self._call("/tickets/{}".format(id), {})
-        return Ticket(
-            id=ticket["summary"]["id"],
-            order_id=ticket["summary"]["order_id"],
-            devices=list(
-                map(
-                    lambda d: Device(
-                        id=d["device"]["id"], name=d["device"]["name"], status=d["status"]["name"]
-                    ),
-                    ticket["devices"],
-                )
-            ),
-            created_date=datetime.fromtimestamp(ticket["summary"]["created_date"]),
-        )
+        if self.ticket_cache is not None:
+            self.ticket_cache.put(id, ticket)
+        return ticket
 
-    def invoice_by_id(self, id: str) -> Invoice:
+    def ticket_by_id(self, id: str) -> Ticket:
+        return _into_ticket(self._ticket_data(id))
+
+    def invoice_by_id(self, id: str, include_ticket: bool = True) -> Invoice:
+        """
+        The invoice, with its ticket fetched as well unless `include_ticket` is False. Callers
+        that only look at the ticket for some invoices can pass False and fetch it themselves
+        from `Invoice.ticket_id`, saving a request for the rest.
+        """
         inv = self._call("/invoices/{}".format(id), {})
 
-        if inv["summary"]["ticket"]["isTicket"]:
+        if include_ticket and inv["summary"]["ticket"]["isTicket"]:
             ticket = self.ticket_by_id(inv["summary"]["ticket"]["id"])
         else:
             ticket = None
 
-        items = []
-        for item in inv["items"]:
-            if item["tax_class"]["tax_percent"] is None:
-                item["tax_class"]["tax_percent"] = 0
-            items.append(
-                Item(
-                    id=item["id"],
-                    name=item["name"],
-                    sku=item["sku"],
-                    notes=item["notes"],
-                    quantity=item["quantity"],
-                    price=Decimal(item["price"]),
-                    tax=Decimal(item["gst"]),
-                    total=Decimal(item["total"]),
-                    tax_class=item["tax_class"]["id"],
-                    tax_percent=Decimal(item["tax_class"]["tax_percent"]),
-                )
+        return _into_invoice(inv, ticket)
+
+    def _map(self, fn, args: list) -> list[Any | Exception]:
+        """`fn` applied to each of `args` on the batch pool, in order, errors returned in place"""
+        futures = [self._executor.submit(fn, arg) for arg in args]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def tickets_by_ids(self, ids: list[str]) -> list[Ticket | Exception]:
+        """
+        Fetches the tickets `batch_concurrency` at a time. Results are in the order of `ids`, a
+        ticket that couldn't be fetched is the exception raised instead. Repeated ids are fetched
+        once.
+        """
+        unique = list(dict.fromkeys(ids))
+        fetched = dict(zip(unique, self._map(self._ticket_data, unique)))
+        return [
+            _into_ticket(fetched[id]) if not isinstance(fetched[id], Exception) else fetched[id]
+            for id in ids
+        ]
+
+    def invoice_by_ids(
+        self, ids: list[str], include_ticket: bool = True
+    ) -> list[Invoice | Exception]:
+        """
+        Like `invoice_by_id` for many invoices, fetched `batch_concurrency` at a time. Results
+        are in the order of `ids`, an invoice that couldn't be fetched (or whose ticket couldn't)
+        is the exception raised instead. Repeated ids, and invoices of the same ticket, share a
+        single fetch.
+        """
+        unique = list(dict.fromkeys(ids))
+        fetched = dict(
+            zip(unique, self._map(lambda id: self._call("/invoices/{}".format(id), {}), unique))
+        )
+        raw = [fetched[id] for id in ids]
+        ticket_ids = [
+            inv["summary"]["ticket"]["id"]
+            for inv in raw
+            if include_ticket
+            and not isinstance(inv, Exception)
+            and inv["summary"]["ticket"]["isTicket"]
+        ]
+        tickets = dict(zip(ticket_ids, self.tickets_by_ids(ticket_ids)))
+
+        invoices: list[Invoice | Exception] = []
+        for inv in raw:
+            if isinstance(inv, Exception):
+                invoices.append(inv)
+            elif not include_ticket or not inv["summary"]["ticket"]["isTicket"]:
+                invoices.append(_into_invoice(inv, None))
+            elif isinstance(ticket := tickets[inv["summary"]["ticket"]["id"]], Exception):
+                invoices.append(ticket)
+            else:
+                invoices.append(_into_invoice(inv, ticket))
+        return invoices
+
+
+# Response parsing, shared by the blocking and the asyncio clients
+
+
+def _into_ticket_statuses(ret: list) -> list[TicketStatus]:
+    return list(map(lambda s: TicketStatus(name=s["name"], color=s["color"], type=s["type"]), ret))
+
+
+def _into_item_match(res: dict, query: str) -> Item:
+    items = res["inventoryListData"]
+
+    match = None
+    for item in items:
+        if item["sku"] == query or item["name"] == query:
+            match = item
+            break
+
+    if match is None:
+        raise ItemNotFound
+    else:
+        return Item(
+            id=match["id"],
+            name=match["name"],
+            sku=match["sku"],
+            notes=None,
+            quantity=None,
+            price=None,
+            tax=None,
+            total=None,
+            tax_percent=None,
+            tax_class=None,
+        )
+
+
+def _invoices_params(
+    from_date: datetime | None,
+    to_date: datetime | None,
+    status: InvoiceStatus | None,
+    keyword: str | None,
+    page_size: int,
+) -> dict[str, Any]:
+    return {
+        "from_date": int(from_date.timestamp()) if from_date is not None else None,
+        "to_date": int(to_date.timestamp()) if to_date is not None else None,
+        "status": status.value if status is not None else None,
+        "keyword": keyword,
+        "pagesize": page_size,
+    }
+
+
+def _unwrap(ret: dict) -> Any:
+    if (
+        not ret["success"]
+        and ret["statusCode"] != 100  # Status code 100 is returned on empty invoice list
+    ):
+        raise ApiError(ret["statusCode"], ret["message"])
+    return ret["data"]
+
+
+def _into_basic_invoices(res: dict | list) -> list[BasicInvoice]:
+    # When no invoices are found a empty list is returned
+    if type(res) is list:
+        return []
+
+    return [_into_basic_invoice(invoice) for invoice in res["invoiceData"]]
+
+
+def _into_basic_invoice(invoice: dict) -> BasicInvoice:
+    return BasicInvoice(
+        id=invoice["summary"]["id"],
+        order_id=invoice["summary"]["order_id"],
+        date=datetime.fromtimestamp(invoice["summary"]["created_date"]),
+        # Sometimes RepairDesk returns no status for some reason
+        status=InvoiceStatus(invoice["summary"]["status"])
+        if "status" in invoice["summary"].keys()
+        else None,
+        customer=BasicCustomer(
+            id=invoice["summary"]["customer"]["id"],
+            name=invoice["summary"]["customer"]["fullName"],
+        ),
+    )
+
+
+def _into_ticket(ticket: dict) -> Ticket:
+    return Ticket(
+        id=ticket["summary"]["id"],
+        order_id=ticket["summary"]["order_id"],
+        devices=list(
+            map(
+                lambda d: Device(
+                    id=d["device"]["id"], name=d["device"]["name"], status=d["status"]["name"]
+                ),
+                ticket["devices"],
+            )
+        ),
+        created_date=datetime.fromtimestamp(ticket["summary"]["created_date"]),
+    )
+
+
+def _into_invoice(inv: dict, ticket: Ticket | None) -> Invoice:
+    items = []
+    for item in inv["items"]:
+        if item["tax_class"]["tax_percent"] is None:
+            item["tax_class"]["tax_percent"] = 0
+        items.append(
+            Item(
+                id=item["id"],
+                name=item["name"],
+                sku=item["sku"],
+                notes=item["notes"],
+                quantity=item["quantity"],
+                price=Decimal(item["price"]),
+                tax=Decimal(item["gst"]),
+                total=Decimal(item["total"]),
+                tax_class=item["tax_class"]["id"],
+                tax_percent=Decimal(item["tax_class"]["tax_percent"]),
             )
+        )
 
-        payments = []
-        for payment in inv["summary"]["payments"]:
-            payments.append(
-                Payment(
-                    id=payment["id"],
-                    amount=Decimal(payment["amount"]),
-                    date=datetime.fromtimestamp(payment["payment_date"]),
-                    method=payment["method"],
-                    notes=payment["notes"],
-                )
+    payments = []
+    for payment in inv["summary"]["payments"]:
+        payments.append(
+            Payment(
+                id=payment["id"],
+                amount=Decimal(payment["amount"]),
+                date=datetime.fromtimestamp(payment["payment_date"]),
+                method=payment["method"],
+                notes=payment["notes"],
             )
+        )
 
-        return Invoice(
-            id=inv["summary"]["id"],
-            order_id=inv["summary"]["order_id"],
-            ticket=ticket,
-            date=datetime.fromtimestamp(inv["summary"]["created_date"]),
-            subtotal=Decimal(inv["summary"]["subtotal_without_symbol"]),
-            total_tax=Decimal(inv["summary"]["total_tax_without_symbol"]),
-            total=Decimal(inv["summary"]["total_without_symbol"]),
-            customer=Customer(
-                full_name=inv["summary"]["customer"]["fullName"],
-                id=inv["summary"]["customer"]["cid"],
-                mobile=inv["summary"]["customer"]["mobile"],
-                address=inv["summary"]["customer"]["address1"],
-                postcode=inv["summary"]["customer"]["postcode"],
-                email=inv["summary"]["customer"]["email"],
-                city=inv["summary"]["customer"]["city"],
-                state=inv["summary"]["customer"]["state"],
-                country=inv["summary"]["customer"]["country"],
-                nif=next(
-                    filter(
-                        lambda i: i["name"] == "nif",
-                        inv["summary"]["customer"]["custom_fields"]
-                        if "custom_fields" in inv["summary"]["customer"].keys()
-                        else [],
-                    ),
-                    {"value": None},
-                )["value"],
-                customer_group_id=inv["summary"]["customer"]["cus_group_id"]
-                if "cus_group_id" in inv["summary"]["customer"].keys()
-                else None,
-            ),
-            status=InvoiceStatus(inv["summary"]["status"])
-            if "status" in inv["summary"].keys()
+    return Invoice(
+        id=inv["summary"]["id"],
+        order_id=inv["summary"]["order_id"],
+        ticket=ticket,
+        ticket_id=inv["summary"]["ticket"]["id"] if inv["summary"]["ticket"]["isTicket"] else None,
+        date=datetime.fromtimestamp(inv["summary"]["created_date"]),
+        subtotal=Decimal(inv["summary"]["subtotal_without_symbol"]),
+        total_tax=Decimal(inv["summary"]["total_tax_without_symbol"]),
+        total=Decimal(inv["summary"]["total_without_symbol"]),
+        customer=Customer(
+            full_name=inv["summary"]["customer"]["fullName"],
+            id=inv["summary"]["customer"]["cid"],
+            mobile=inv["summary"]["customer"]["mobile"],
+            address=inv["summary"]["customer"]["address1"],
+            postcode=inv["summary"]["customer"]["postcode"],
+            email=inv["summary"]["customer"]["email"],
+            city=inv["summary"]["customer"]["city"],
+            state=inv["summary"]["customer"]["state"],
+            country=inv["summary"]["customer"]["country"],
+            nif=next(
+                filter(
+                    lambda i: i["name"] == "nif",
+                    inv["summary"]["customer"]["custom_fields"]
+                    if "custom_fields" in inv["summary"]["customer"].keys()
+                    else [],
+                ),
+                {"value": None},
+            )["value"],
+            customer_group_id=inv["summary"]["customer"]["cus_group_id"]
+            if "cus_group_id" in inv["summary"]["customer"].keys()
             else None,
-            items=items,
-            payments=payments,
-            notes=inv["summary"]["notes"],
-        )
+        ),
+        status=InvoiceStatus(inv["summary"]["status"])
+        if "status" in inv["summary"].keys()
+        else None,
+        items=items,
+        payments=payments,
+        notes=inv["summary"]["notes"],
+    )
+
+
+from .aio import AsyncRepairDesk  # noqa: E402, F401  (needs the definitions above)
@@ -0,0 +1,130 @@
+# asyncio front-end for the RepairDesk client
+#
+# Requests still go through the blocking `RepairDesk._call` (and therefore through its pooled
+# session) but run on a dedicated thread pool, so many of them can be in flight at once. The
+# number of concurrent requests is capped by `concurrency`, keep it at or below the client's
+# `pool_size`.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+import repairdesk
+from repairdesk import (
+    BasicInvoice,
+    Invoice,
+    InvoiceStatus,
+    Item,
+    RepairDesk,
+    Ticket,
+    TicketStatus,
+)
+
+
+@dataclass
+class AsyncRepairDesk:
+    client: RepairDesk
+    concurrency: int = 8
+    _executor: ThreadPoolExecutor = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Not tied to an event loop, so the same client can be used by successive `asyncio.run`
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="repairdesk"
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, fn, *args) -> Any:
+        # With the caller's context variables, as `asyncio.to_thread` does
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, ctx.run, fn, *args)
+
+    async def _call(self, endpoint: str, params: dict[str, Any]) -> Any:
+        return await self._run(self.client._call, endpoint, params)
+
+    async def ticket_statuses(self) -> list[TicketStatus]:
+        return repairdesk._into_ticket_statuses(await self._call("/statuses", {}))
+
+    # Searches an item by either name or SKU
+    async def search_item(self, query: str) -> Item:
+        return repairdesk._into_item_match(
+            await self._call("/inventory", {"keyword": query}), query
+        )
+
+    async def invoices(
+        self,
+        from_date: datetime | None = None,
+        to_date: datetime | None = None,
+        status: InvoiceStatus | None = None,
+        keyword: str | None = None,
+        page_size: int = 50,
+    ) -> list[BasicInvoice]:
+        return repairdesk._into_basic_invoices(
+            await self._call(
+                "/invoices",
+                repairdesk._invoices_params(from_date, to_date, status, keyword, page_size),
+            )
+        )
+
+    async def ticket_by_id(self, id: str) -> Ticket:
+        # Through the client's ticket cache, if any
+        return repairdesk._into_ticket(await self._run(self.client._ticket_data, id))
+
+    async def invoice_by_id(self, id: str, include_ticket: bool = True) -> Invoice:
+        inv = await self._call("/invoices/{}".format(id), {})
+
+        if include_ticket and inv["summary"]["ticket"]["isTicket"]:
+            ticket = await self.ticket_by_id(inv["summary"]["ticket"]["id"])
+        else:
+            ticket = None
+
+        return repairdesk._into_invoice(inv, ticket)
+
+    async def tickets_by_ids(self, ids: list[str]) -> list[Ticket | BaseException]:
+        """Like `RepairDesk.tickets_by_ids`, capped by `concurrency` instead"""
+        unique = list(dict.fromkeys(ids))
+        fetched = dict(
+            zip(
+                unique,
+                await asyncio.gather(
+                    *(self.ticket_by_id(id) for id in unique), return_exceptions=True
+                ),
+            )
+        )
+        return [fetched[id] for id in ids]
+
+    async def invoice_by_ids(
+        self, ids: list[str], include_ticket: bool = True
+    ) -> list[Invoice | BaseException]:
+        """Like `RepairDesk.invoice_by_ids`, capped by `concurrency` instead"""
+        unique = list(dict.fromkeys(ids))
+        results = await asyncio.gather(
+            *(self._call("/invoices/{}".format(id), {}) for id in unique), return_exceptions=True
+        )
+        fetched = dict(zip(unique, results))
+        raw = [fetched[id] for id in ids]
+        ticket_ids = [
+            inv["summary"]["ticket"]["id"]
+            for inv in raw
+            if include_ticket
+            and not isinstance(inv, BaseException)
+            and inv["summary"]["ticket"]["isTicket"]
+        ]
+        tickets = dict(zip(ticket_ids, await self.tickets_by_ids(ticket_ids)))
+
+        invoices: list[Invoice | BaseException] = []
+        for inv in raw:
+            if isinstance(inv, BaseException):
+                invoices.append(inv)
+            elif not include_ticket or not inv["summary"]["ticket"]["isTicket"]:
+                invoices.append(repairdesk._into_invoice(inv, None))
+            elif isinstance(ticket := tickets[inv["summary"]["ticket"]["id"]], BaseException):
+                invoices.append(ticket)
+            else:
+                invoices.append(repairdesk._into_invoice(inv, ticket))
+        return invoices
@@ -0,0 +1,120 @@
+# Ticket caching
+#
+# Fetching an invoice that comes from a ticket takes a second request for the ticket. Tickets whose
+# devices are all in a "Closed" status practically never change, so they are kept for a long time,
+# while open ones expire quickly. Entries are the raw API payloads, so any backend able to store
+# JSON can hold them: `MemoryBackend` for a single process, `SQLiteBackend` to keep them across
+# restarts or share them between processes.
+
+from collections.abc import Iterable
+from datetime import timedelta
+import json
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Protocol
+
+
+class CacheBackend(Protocol):
+    def get(self, key: str) -> Any | None: ...
+
+    def set(self, key: str, value: Any, ttl: float): ...
+
+    def delete(self, key: str): ...
+
+
+class MemoryBackend:
+    """Per-process dict, the oldest entries are dropped beyond `max_entries`"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: dict[str, tuple[float, Any]] = {}
+        self._lock = Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteBackend:
+    """Entries stored as JSON in a SQLite database at `path`, expired ones are purged on write"""
+
+    def __init__(self, path: str):
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries"
+            " (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires > ?", (key, time())
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time()
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl),
+            )
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+
+class TicketCache:
+    """
+    Raw ticket payloads by ticket id. Tickets with every device in one of `closed_statuses` are
+    kept for `closed_ttl`, the rest for `open_ttl`. `closed_statuses` can be updated at any time,
+    it applies to tickets cached from then on.
+    """
+
+    def __init__(
+        self,
+        backend: CacheBackend | None = None,
+        closed_statuses: Iterable[str] = (),
+        closed_ttl: timedelta = timedelta(days=30),
+        open_ttl: timedelta = timedelta(minutes=10),
+    ):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.closed_statuses = set(closed_statuses)
+        self.closed_ttl = closed_ttl
+        self.open_ttl = open_ttl
+
+    def is_closed(self, ticket: dict) -> bool:
+        devices = ticket["devices"]
+        return bool(devices) and all(d["status"]["name"] in self.closed_statuses for d in devices)
+
+    def get(self, id: str) -> dict | None:
+        return self.backend.get(str(id))
+
+    def put(self, id: str, ticket: dict):
+        ttl = self.closed_ttl if self.is_closed(ticket) else self.open_ttl
+        self.backend.set(str(id), ticket, ttl.total_seconds())
+
+    def invalidate(self, id: str):
+        self.backend.delete(str(id))
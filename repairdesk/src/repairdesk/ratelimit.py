@@ -0,0 +1,105 @@
+# Client-side rate limiting
+#
+# Requests are paced with a token bucket per endpoint class ("read" for GET, "write" for
+# everything else). When the API answers 429 the whole class is paused for the time the server
+# asks for in `Retry-After`, so callers wait exactly as long as needed instead of hammering the
+# API or sleeping for an arbitrary amount of time.
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic, sleep
+
+import requests
+
+# Seconds to wait after a 429 that carries no usable `Retry-After`
+DEFAULT_RETRY_AFTER = 5.0
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average with bursts of up to `capacity` requests.
+    A rate of None disables pacing, pauses requested through `pause` are still honored.
+    Thread-safe: callers reserve a token under the lock and sleep outside of it.
+    """
+
+    def __init__(self, rate: float | None, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        # No tokens accrue while paused
+        since = max(self._updated, self._paused_until)
+        if self.rate is not None and now > since:
+            self._tokens = min(self.capacity, self._tokens + (now - since) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            ready = max(now, self._paused_until)
+            if self.rate is not None:
+                self._tokens -= 1
+                ready += max(0.0, -self._tokens / self.rate)
+        if ready > now:
+            sleep(ready - now)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Start paced again once the pause ends instead of releasing a full burst
+            self._tokens = min(self._tokens, 0.0)
+
+
+class RateLimiter:
+    """
+    Token buckets for the "read" and "write" endpoint classes of one API. Rates are in requests
+    per second, None means unlimited.
+    """
+
+    def __init__(
+        self,
+        read: float | None = None,
+        write: float | None = None,
+        read_burst: int = 1,
+        write_burst: int = 1,
+    ):
+        self.buckets = {
+            "read": TokenBucket(read, read_burst),
+            "write": TokenBucket(write, write_burst),
+        }
+
+    @staticmethod
+    def endpoint_class(method: str) -> str:
+        return "read" if method.upper() == "GET" else "write"
+
+    def acquire(self, method: str):
+        self.buckets[self.endpoint_class(method)].acquire()
+
+    def pause(self, method: str, seconds: float):
+        self.buckets[self.endpoint_class(method)].pause(seconds)
+
+
+def retry_after(response: requests.Response, default: float = DEFAULT_RETRY_AFTER) -> float:
+    """Seconds to wait according to the `Retry-After` header, which can be seconds or a date"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
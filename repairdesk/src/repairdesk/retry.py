@@ -0,0 +1,83 @@
+# Retry policy and circuit breaker for API calls
+#
+# Failed requests are retried a bounded number of times with exponential backoff and full
+# jitter. Consecutive failures open a circuit breaker, while open every call fails fast with
+# `CircuitOpen` instead of waiting on a remote that is known to be down. After `reset_timeout`
+# seconds a single trial call is let through ("half-open"), closing the breaker if it succeeds.
+
+from dataclasses import dataclass
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+
+class RemoteUnavailable(Exception):
+    """The API could not be reached after exhausting all retries"""
+
+
+class CircuitOpen(RemoteUnavailable):
+    """The circuit breaker is open, the call was not attempted"""
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 5
+    # Seconds, the delay before retry `n` is drawn from [0, min(max_delay, base_delay * 2^n)]
+    base_delay: float = 1
+    max_delay: float = 60
+
+    def delay(self, attempt: int) -> float:
+        return uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._trial_running = False
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if now - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def retry_in(self) -> float:
+        """Seconds until calls are let through again, 0 if they are right now"""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - monotonic())
+
+    def check(self):
+        """Raises `CircuitOpen` if the call must not be attempted"""
+        with self._lock:
+            state = self._state(monotonic())
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return
+        raise CircuitOpen("circuit breaker is {}".format(state))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = monotonic()
+            self._trial_running = False
@@ -0,0 +1,66 @@
+# Incremental decoding of large JSON list responses
+#
+# `iter_json_array` yields the elements of an array nested in a JSON document while the document
+# is still being downloaded, so peak memory is bounded by one element (plus a read chunk) instead
+# of the whole body and every object built from it.
+
+import codecs
+import json
+import re
+from typing import Any, Generator, Iterable
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = " \t\n\r,"
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str) -> Generator[Any, None, Any]:
+    """
+    Yields the elements of the first array stored under `key` in the UTF-8 JSON document read
+    from `chunks`, decoding them one at a time. If the document has no such array (e.g. an
+    error response) nothing is yielded and the whole document is decoded and returned instead.
+    """
+    start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+
+    # Everything up to the array is kept, it is small and needed if the array never shows up
+    buf = ""
+    while (match := start.search(buf)) is None:
+        chunk = next(chunks, None)
+        if chunk is None:
+            return json.loads(buf + utf8.decode(b"", final=True))
+        buf += utf8.decode(chunk)
+
+    buf = buf[match.end() :]
+    pos = 0
+    exhausted = False
+    while True:
+        while pos < len(buf) and buf[pos] in _SEPARATORS:
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == "]":
+            return None
+
+        item, end = None, None
+        if pos < len(buf):
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+
+        # An element ending right at the end of the buffer might be cut short (e.g. a number)
+        if end is None or (end == len(buf) and not exhausted):
+            chunk = next(chunks, None)
+            if chunk is None:
+                if exhausted:
+                    raise ValueError("JSON document ended inside the {!r} array".format(key))
+                exhausted = True
+                buf = buf[pos:] + utf8.decode(b"", final=True)
+            else:
+                buf = buf[pos:] + utf8.decode(chunk)
+            pos = 0
+            continue
+
+        yield item
+        pos = end